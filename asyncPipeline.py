@@ -0,0 +1,187 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from speckleCalculator import analyzeMeasurementIsolated, analyzeMeasurementInNewProcess, prefetchMeasurementFiles, saveMeasurementResults, flushResultSinks, closeResultSinks
+
+'''
+Asyncio API for analyzing measurements while they arrive, e.g. from a capture station writing to a network share.
+Measurements (dicts like in examples.py) are taken from an (async) iterable. Their files are read in a thread pool
+and the analysis runs in a process pool, so reading the next files overlaps with the computation of the previous ones.
+Bounded queues between the stages provide backpressure: no more than maxQueued measurements are read ahead of the workers.
+Results are yielded in the order they complete.
+
+Usage:
+    async for measurement, results in analyzeStream(measurements, workers=4, perforationThreshold=30):
+        ...
+'''
+
+# Polling interval and timeout (in s) while waiting for the files of a measurement to be written completely
+FILE_POLL_INTERVAL = 0.5
+FILE_WAIT_TIMEOUT = 600
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+# Analyzes the measurements of an iterable or async iterable and yields (measurement, results) as soon as each one is finished.
+# results is the exception of a failed measurement, the stream continues. Results are saved to their saveFileName by this process.
+# The perforation mask can't be chosen interactively, every measurement needs a "perforationThreshold" or a default has to be given.
+# With waitForFiles the files of a measurement are awaited until they exist and their size doesn't change anymore (failed after FILE_WAIT_TIMEOUT).
+# If a worker process dies (e.g. rawpy/LibRaw crashing on a corrupt file) the process pool is replaced and the measurements that were
+# running in it are analyzed again one at a time in a new process, so only the crashing measurement fails.
+# Saving the results and waiting for files run in a thread, so a slow network share doesn't stall the event loop.
+# On Windows the calling script has to be guarded with if __name__ == "__main__".
+async def analyzeStream(measurements, workers=os.cpu_count(), perforationThreshold=None, maxQueued=None, waitForFiles=False):
+    stream = analyzeIndexedStream(measurements, workers, perforationThreshold, maxQueued, waitForFiles)
+    try:
+        async for _, measurement, results in stream:
+            yield measurement, results
+    finally:
+        await stream.aclose()
+
+# Runs analyzeStream() to the end and returns the results in the order the measurements were given
+def analyzeStreamBlocking(measurements, workers=os.cpu_count(), perforationThreshold=None, maxQueued=None, waitForFiles=False):
+    measurements = list(measurements)
+
+    async def collectResults():
+        batchResults = [None] * len(measurements)
+        async for index, _, results in analyzeIndexedStream(measurements, workers, perforationThreshold, maxQueued, waitForFiles):
+            batchResults[index] = results
+        return batchResults
+
+    return asyncio.run(collectResults())
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Same as analyzeStream(), yields (index, measurement, results) with the index of the measurement in the input
+# (a measurement dict given several times is analyzed and yielded for every index)
+async def analyzeIndexedStream(measurements, workers=os.cpu_count(), perforationThreshold=None, maxQueued=None, waitForFiles=False):
+    loop = asyncio.get_running_loop()
+    readFiles = asyncio.Queue(maxsize=maxQueued or 2*workers)
+    finishedResults = asyncio.Queue()
+    resultSinks = {}
+    processPool = ProcessPoolExecutor(max_workers=workers)
+    filePool = ThreadPoolExecutor(max_workers=workers)
+    isolationLock = asyncio.Lock()
+
+    # Reads the files of the measurements ahead, waits while the queue is full
+    # The analyzers are stopped after the last measurement, also if the source fails (its error is raised by analyzeStream())
+    async def readMeasurements():
+        try:
+            index = 0
+            async for measurement in iterateMeasurements(measurements):
+                index += 1
+                if waitForFiles:
+                    try:
+                        await waitForMeasurementFiles(measurement, executor=filePool)
+                    except Exception as error:
+                        await finishedResults.put((index - 1, measurement, error))
+                        continue
+                await loop.run_in_executor(filePool, prefetchMeasurementFiles, measurement)
+                await readFiles.put((index - 1, measurement))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await stopAnalyzers()
+            raise
+        await stopAnalyzers()
+
+    async def stopAnalyzers():
+        for _ in range(workers):
+            await readFiles.put(None)
+
+    # Analyzes one measurement after another in the process pool, the workers don't write to the result tables
+    async def analyzeMeasurements():
+        nonlocal processPool
+        try:
+            while (queued := await readFiles.get()) is not None:
+                index, measurement = queued
+                workerMeasurement = dict(measurement, saveFileName=None)
+                usedPool = processPool
+                try:
+                    results = await loop.run_in_executor(usedPool, analyzeMeasurementIsolated, workerMeasurement, perforationThreshold)
+                except BrokenProcessPool:
+                    # The first analyzer noticing the crash replaces the pool, the crashed measurements are retried one after another
+                    if processPool is usedPool:
+                        print(" ! A worker process crashed, the measurements that were running are analyzed again one at a time")
+                        usedPool.shutdown(wait=False, cancel_futures=True)
+                        processPool = ProcessPoolExecutor(max_workers=workers)
+                    async with isolationLock:
+                        results = await loop.run_in_executor(filePool, analyzeMeasurementInNewProcess, workerMeasurement, perforationThreshold)
+                except Exception as error:
+                    results = error
+                await finishedResults.put((index, measurement, results))
+        finally:
+            await finishedResults.put(None)
+
+    reader = asyncio.ensure_future(readMeasurements())
+    analyzers = [asyncio.ensure_future(analyzeMeasurements()) for _ in range(workers)]
+    try:
+        runningAnalyzers = workers
+        while runningAnalyzers > 0:
+            finished = await finishedResults.get()
+            if finished is None:
+                runningAnalyzers -= 1
+                continue
+            index, measurement, results = finished
+            if isinstance(results, Exception):
+                print(" ! Measurement '" + str(measurement.get("imgName")) + "' failed: " + str(results))
+            else:
+                # Only this generator writes to the result sinks, one measurement after another
+                await loop.run_in_executor(filePool, saveAndFlushResults, measurement, results, resultSinks)
+            yield index, measurement, results
+
+        # Raises errors of the measurement source
+        await reader
+    finally:
+        for task in [reader] + analyzers:
+            task.cancel()
+        await asyncio.gather(reader, *analyzers, return_exceptions=True)
+        closeResultSinks(resultSinks)
+        processPool.shutdown(wait=False, cancel_futures=True)
+        filePool.shutdown(wait=False, cancel_futures=True)
+
+# Waits until the files of a measurement exist and their size is the same at two polls, raises an exception after the timeout
+# The file sizes are read in the executor (None: the default executor of the loop), so a slow share doesn't block the event loop
+async def waitForMeasurementFiles(measurement, pollInterval=FILE_POLL_INTERVAL, timeout=FILE_WAIT_TIMEOUT, executor=None):
+    names = [measurement["imgName"]]
+    if measurement.get("useRefImg", True):
+        names.append(measurement.get("refName", ""))
+    filePaths = [measurement["path"] + name + "." + measurement["datatype"] for name in names]
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    lastSizes = None
+    while True:
+        sizes = await loop.run_in_executor(executor, getFileSizes, filePaths)
+        if None not in sizes and sizes == lastSizes:
+            return
+        if loop.time() > deadline:
+            raise Exception(" ! The files of measurement '" + str(measurement["imgName"]) + "' weren't written within " + str(timeout) + " s.")
+        lastSizes = sizes
+        await asyncio.sleep(pollInterval)
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+# Returns the size of every file, None for files that don't exist (yet)
+def getFileSizes(filePaths):
+    return [os.path.getsize(filePath) if os.path.isfile(filePath) else None for filePath in filePaths]
+
+# Saves the results of a measurement to its result table and writes them to disk
+def saveAndFlushResults(measurement, results, resultSinks):
+    saveMeasurementResults(measurement, results, resultSinks)
+    flushResultSinks(resultSinks)
+
+# Iterates over an iterable or an async iterable
+async def iterateMeasurements(measurements):
+    if hasattr(measurements, "__aiter__"):
+        async for measurement in measurements:
+            yield measurement
+    else:
+        for measurement in measurements:
+            yield measurement
@@ -0,0 +1,196 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+from dataManager import parseNumber
+
+'''
+Command line runner for batches of measurements.
+The measurements are read from a manifest, either a json file with a list of measurement dicts (see examples.py)
+or a csv file with one measurement per row. Relative paths in the manifest are relative to the manifest file.
+The batch is analyzed with speckleCalculator.analyzeMeasurementBatch(). Every finished measurement is recorded in a progress
+journal (json lines next to the manifest), so an interrupted run continues with the unfinished measurements when it is started again.
+Failed measurements are recorded as well and retried in the next run.
+
+Usage: python batchRunner.py measurements.json --workers 4 --perforation-threshold 30 --save-file results --raw-threads 2
+'''
+
+# Columns of a csv manifest that are measurement keys, all other columns are stored in "metadata"
+MEASUREMENT_KEYS = ["path", "refName", "imgName", "datatype", "useRefImg", "debayerChannel", "saveFileName", "perforationThreshold",
+                    "filterMode", "filterBackend", "useCache", "profile", "cropFirst", "precision", "bitDepth", "rawThreads", "tileRows", "coarseStep"]
+BOOLEAN_KEYS = ["useRefImg", "useCache", "profile", "cropFirst", "projInFocus"]
+TEXT_KEYS = ["path", "refName", "imgName", "datatype", "saveFileName", "filterMode", "filterBackend", "precision", "camera"]
+INTEGER_KEYS = ["bitDepth", "rawThreads", "tileRows", "coarseStep"]
+# Measurement keys that only change how a measurement is computed, not its results, they aren't part of the key in the journal
+EXECUTION_KEYS = ["rawThreads", "tileRows"]
+JOURNAL_SUFFIX = ".progress.jsonl"
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze the measurements of a json or csv manifest, interrupted runs are resumed.")
+    parser.add_argument("manifest", help="json or csv file with the measurements")
+    parser.add_argument("--workers", type=int, default=1, help="parallel processes (needs a perforation threshold)")
+    parser.add_argument("--perforation-threshold", default=None, help="threshold or 'otsu'/'valley' for measurements without one")
+    parser.add_argument("--save-file", default=None, help="result table for measurements without a saveFileName")
+    parser.add_argument("--raw-threads", type=int, default=None, help="threads normalizing and debayering each RAW image, per worker (see rawProcessor.py)")
+    parser.add_argument("--tile-rows", type=int, default=None, help="rows per band of the multi-threaded RAW processing")
+    parser.add_argument("--journal", default=None, help="progress journal (default: manifest name + " + JOURNAL_SUFFIX + ")")
+    parser.add_argument("--restart", action="store_true", help="ignore the journal and analyze all measurements again")
+    args = parser.parse_args()
+
+    perforationThreshold = parseNumber(args.perforation_threshold) if args.perforation_threshold is not None else None
+    summary = runManifest(args.manifest, args.workers, perforationThreshold, args.save_file, args.journal, args.restart, args.raw_threads, args.tile_rows)
+    sys.exit(0 if summary["failed"] == 0 and not summary["interrupted"] else 1)
+
+# Analyzes all measurements of the manifest that aren't finished according to the journal and returns a summary of the run
+# saveFileName, rawThreads and tileRows are used for measurements that don't set them
+def runManifest(manifestPath, workers=1, perforationThreshold=None, saveFileName=None, journalPath=None, restart=False, rawThreads=None, tileRows=None):
+    from speckleCalculator import analyzeMeasurementBatch
+
+    measurements = loadManifest(manifestPath)
+    for key, value in [("saveFileName", saveFileName), ("rawThreads", rawThreads), ("tileRows", tileRows)]:
+        if value is not None:
+            for measurement in measurements:
+                measurement.setdefault(key, value)
+
+    journalPath = journalPath if journalPath is not None else manifestPath + JOURNAL_SUFFIX
+    if restart and os.path.isfile(journalPath):
+        os.remove(journalPath)
+    finishedKeys = readFinishedKeys(journalPath)
+    keys = [getMeasurementKey(measurement) for measurement in measurements]
+    pending = [index for index, key in enumerate(keys) if key not in finishedKeys]
+    print("Manifest '" + manifestPath + "': " + str(len(measurements)) + " measurements, " + str(len(measurements) - len(pending)) + " already finished")
+
+    summary = {"total": len(measurements), "skipped": len(measurements) - len(pending), "finished": 0, "failed": 0, "seconds": 0.0, "interrupted": False}
+    startTime = time.perf_counter()
+
+    with openJournal(journalPath) as journal:
+        def recordResult(batchIndex, results):
+            measurement = measurements[pending[batchIndex]]
+            failed = isinstance(results, Exception)
+            summary["failed" if failed else "finished"] += 1
+            entry = {"key": keys[pending[batchIndex]], "imgName": measurement.get("imgName"), "status": "failed" if failed else "done",
+                     "time": datetime.datetime.now().isoformat()}
+            if failed:
+                entry["error"] = str(results)
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        try:
+            if pending:
+                analyzeMeasurementBatch([measurements[index] for index in pending], workers, perforationThreshold,
+                                        resultCallback=recordResult, stopOnError=False)
+        except KeyboardInterrupt:
+            summary["interrupted"] = True
+
+    summary["seconds"] = time.perf_counter() - startTime
+    printSummary(summary)
+    return summary
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Reads the measurements of a json (list of measurement dicts or {"measurements": [...]}) or csv manifest
+# The path of every measurement is resolved relative to the manifest and ends with a separator
+def loadManifest(manifestPath):
+    if manifestPath.lower().endswith(".csv"):
+        with open(manifestPath, "r", newline="") as file:
+            measurements = [parseManifestRow(row) for row in csv.DictReader(file)]
+    else:
+        with open(manifestPath, "r") as file:
+            measurements = json.load(file)
+        if isinstance(measurements, dict):
+            measurements = measurements["measurements"]
+
+    manifestDir = os.path.dirname(os.path.abspath(manifestPath))
+    for measurement in measurements:
+        if "imgName" not in measurement or "datatype" not in measurement:
+            raise Exception(" ! Every measurement of '" + manifestPath + "' needs an 'imgName' and a 'datatype'.")
+        measurement["path"] = resolveManifestPath(measurement.get("path", ""), manifestDir)
+    return measurements
+
+# Converts a csv row to a measurement dict. Empty cells are left out, columns that aren't measurement keys go into "metadata".
+# Several channels can be given separated by spaces, commas or semicolons (e.g. "r;g;b").
+def parseManifestRow(row):
+    measurement = {}
+    metadata = {}
+    for key, value in row.items():
+        if key is None or value is None or value.strip() == "":
+            continue
+        value = value.strip()
+        if key in BOOLEAN_KEYS:
+            value = value.lower() in ("1", "true", "yes", "y")
+        elif key == "debayerChannel":
+            channels = value.replace(",", " ").replace(";", " ").split()
+            value = channels if len(channels) > 1 else channels[0]
+        elif key not in TEXT_KEYS:
+            value = parseNumber(value)
+            if key in INTEGER_KEYS:
+                value = int(value)
+
+        if key in MEASUREMENT_KEYS:
+            measurement[key] = value
+        else:
+            metadata[key] = value
+    if metadata:
+        measurement["metadata"] = metadata
+    return measurement
+
+# Returns the keys of the measurements that are recorded as done in the journal (an incomplete last line of an interrupted run is ignored)
+def readFinishedKeys(journalPath):
+    finishedKeys = set()
+    if not os.path.isfile(journalPath):
+        return finishedKeys
+    with open(journalPath, "r") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("status") == "done":
+                finishedKeys.add(entry["key"])
+    return finishedKeys
+
+# Opens the journal for appending, an incomplete last line of an interrupted run is terminated first
+def openJournal(journalPath):
+    journal = open(journalPath, "a+")
+    if journal.tell() > 0:
+        journal.seek(journal.tell() - 1)
+        if journal.read(1) != "\n":
+            journal.write("\n")
+    return journal
+
+# Returns the key of a measurement in the journal, a measurement that is changed in the manifest is analyzed again (changes of EXECUTION_KEYS are ignored)
+def getMeasurementKey(measurement):
+    keyedMeasurement = {key: value for key, value in measurement.items() if key not in EXECUTION_KEYS}
+    return hashlib.blake2b(json.dumps(keyedMeasurement, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+# Accepts / and \ as separators, relative paths are relative to baseDir
+def resolveManifestPath(path, baseDir):
+    path = path.replace("\\", os.sep).replace("/", os.sep)
+    return os.path.join(baseDir, path, "")
+
+def printSummary(summary):
+    throughput = summary["finished"] / summary["seconds"] if summary["seconds"] > 0 else 0.0
+    print("__________________")
+    print("Finished {} of {} measurements ({} skipped, {} failed) in {:.1f} s: {:.2f} images/s".format(
+          summary["finished"] + summary["skipped"], summary["total"], summary["skipped"], summary["failed"], summary["seconds"], throughput))
+    if summary["interrupted"]:
+        print(" ! The run was interrupted, start it again to continue with the unfinished measurements.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import os
+from rawProcessor import normalizeRawImage, debayerSingleColor, processBayerImageTiled, RED, GREEN_1, BLUE, GREEN_2
+from speckleCore import findBrightestArea, cropImage, flattenImage, getImagePerforationMask, highPassFilter2D, highPassFilterFlat, calculateSpeckleContrast
+from speckleCalculator import calculateProjectionSpeckle
+from tests.referenceImplementations import debayerSingleColorLoop
+
+'''
+Benchmark of the speckle pipeline on synthetic RAW frames (no images and no display needed).
+The frames are Bayer mosaics of a smooth illumination multiplied with speckle of known contrast and a grid of dark perforations.
+Every stage is timed (min and median of several runs) and its peak allocated memory is measured with tracemalloc.
+The results are written as json, a previous result file can be given with --compare to print the change per stage.
+The import time of the lightweight modules is measured in a fresh interpreter. With --check-imports the benchmark fails
+if one of them takes longer than IMPORT_TIME_BUDGET or loads one of the HEAVY_MODULES at import.
+
+Usage: python benchmark.py --sizes 12 20 --patterns RGGB BGGR --repeat 3 --output bench.json --compare old.json
+'''
+
+# Bayer patterns as rawpy raw_pattern
+BAYER_PATTERNS = {
+    "RGGB": [[RED, GREEN_1], [GREEN_2, BLUE]],
+    "GRBG": [[GREEN_1, RED], [BLUE, GREEN_2]],
+    "GBRG": [[GREEN_1, BLUE], [RED, GREEN_2]],
+    "BGGR": [[BLUE, GREEN_1], [GREEN_2, RED]]
+}
+
+# Sensor sizes (height, width) by megapixels
+SENSOR_SIZES = {
+    12: (2832, 4240),
+    20: (3888, 5184),
+    45: (5464, 8192)
+}
+
+BLACK_LEVEL = [143, 143, 143, 143]
+WHITE_LEVEL = [4095, 4095, 4095, 4095]
+SPECKLE_CONTRAST = 0.25 # Contrast of the synthetic speckle (std / mean)
+PERFORATION_THRESHOLD = 30
+# Size of the corner of the normalized image debayered by the previous pure-Python loop (too slow for whole frames) and by debayerSingleColor() for comparison
+LOOP_DEBAYER_SIZE = 512
+
+# Modules that have to import fast (e.g. in short-lived workers) and the modules they may only load when their features are used
+LIGHTWEIGHT_MODULES = ["speckleCore", "rawProcessor", "imageLoader", "speckleCalculator", "cameraSettingCalculator"]
+HEAVY_MODULES = ["rawpy", "cv2", "scipy", "matplotlib"]
+IMPORT_TIME_BUDGET = 0.5 # in s, per module in a fresh interpreter (including numpy)
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the speckle pipeline on synthetic RAW frames.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SENSOR_SIZES), choices=list(SENSOR_SIZES), help="sensor sizes in megapixels")
+    parser.add_argument("--patterns", nargs="+", default=list(BAYER_PATTERNS), choices=list(BAYER_PATTERNS), help="bayer patterns")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--output", default="", help="json file to write the results to")
+    parser.add_argument("--compare", default="", help="json file of a previous run to compare with")
+    parser.add_argument("--check-imports", action="store_true", help="only measure the imports, fail if one exceeds the budget")
+    args = parser.parse_args()
+
+    if args.check_imports:
+        imports = measureImports()
+        printImports(imports)
+        sys.exit(0 if all(entry["withinBudget"] for entry in imports) else 1)
+
+    results = runBenchmark(args.sizes, args.patterns, args.repeat)
+    results["imports"] = measureImports()
+    printResults(results)
+    printImports(results["imports"])
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as file:
+            printComparison(json.load(file), results)
+
+# Runs all stages for every size and pattern and returns the results as a json serializable dict
+def runBenchmark(sizes, patterns, repeat=3):
+    results = {"environment": getEnvironment(), "speckleContrast": SPECKLE_CONTRAST, "stages": [], "contrast": []}
+
+    for size in sizes:
+        for pattern in patterns:
+            print("Benchmarking " + str(size) + " MP " + pattern + "...", file=sys.stderr)
+            refRaw = createSyntheticRawImage(SENSOR_SIZES[size], speckleContrast=0.0, seed=1)
+            speckleRaw = createSyntheticRawImage(SENSOR_SIZES[size], speckleContrast=SPECKLE_CONTRAST, seed=2)
+
+            for stage, stageFunction in getStages(refRaw, speckleRaw, pattern):
+                seconds, peakBytes, stageResult = measureStage(stageFunction, repeat)
+                results["stages"].append({"megapixels": size, "pattern": pattern, "stage": stage,
+                                          "secondsMin": min(seconds), "secondsMedian": float(np.median(seconds)), "peakBytes": peakBytes})
+
+            # Accuracy of the pipeline on the known contrast (the end-to-end stage is the last one)
+            speckleResults = stageResult
+            results["contrast"].append({"megapixels": size, "pattern": pattern, "expected": SPECKLE_CONTRAST*100,
+                                        "filtered": float(speckleResults["fi_speck"]), "final": float(speckleResults["dif_speck"])})
+    return results
+
+# Returns (name, function) of all stages. Every function runs its stage on the output of the previous stages.
+def getStages(refRaw, speckleRaw, pattern):
+    bayerPattern = BAYER_PATTERNS[pattern]
+    quiet = lambda function: lambda: runQuiet(function)
+
+    normalized = runQuiet(lambda: normalizeRawImage(speckleRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL))
+    debayered = debayerSingleColor(normalized, "g")
+    refDebayered = debayerSingleColor(runQuiet(lambda: normalizeRawImage(refRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL)), "g")
+    areaSize = max(int(debayered.shape[1]/9), 400)
+    cropFilter = findBrightestArea(debayered, (areaSize, areaSize))
+    cropped = cropImage(debayered, cropFilter)
+    perfMask = getImagePerforationMask(cropImage(refDebayered, cropFilter), PERFORATION_THRESHOLD)
+    flattened = flattenImage(cropped, perfMask)
+    loopCorner = normalized[:LOOP_DEBAYER_SIZE, :LOOP_DEBAYER_SIZE]
+    loopSize = str(loopCorner.shape[0]) + "x" + str(loopCorner.shape[1])
+
+    return [
+        ("normalizeRawImage", quiet(lambda: normalizeRawImage(speckleRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL))),
+        ("normalizeRawImage (per channel levels)", quiet(lambda: normalizeRawImage(speckleRaw, bayerPattern, [143, 150, 160, 150], WHITE_LEVEL))),
+        ("normalizeRawImage (uint16)", quiet(lambda: normalizeRawImage(speckleRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL, np.uint16, whiteValue=2**16-1))),
+        ("normalizeRawImage (float32)", quiet(lambda: normalizeRawImage(speckleRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL, np.float32))),
+        ("debayerSingleColor (g)", lambda: debayerSingleColor(normalized, "g")),
+        ("debayerSingleColor (r)", lambda: debayerSingleColor(normalized, "r")),
+        ("debayerSingleColor (g, " + loopSize + ")", lambda: debayerSingleColor(loopCorner, "g")),
+        ("debayerSingleColor (g, " + loopSize + ", loop)", lambda: debayerSingleColorLoop(loopCorner, "g")),
+        ("debayerSingleColor (r, " + loopSize + ")", lambda: debayerSingleColor(loopCorner, "r")),
+        ("debayerSingleColor (r, " + loopSize + ", loop)", lambda: debayerSingleColorLoop(loopCorner, "r")),
+        ("normalize + debayer (g)", quiet(lambda: debayerSingleColor(normalizeRawImage(speckleRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL), "g"))),
+        ("normalize + debayer (g, tiled, " + str(os.cpu_count()) + " threads)",
+         quiet(lambda: processBayerImageTiled(speckleRaw, bayerPattern, BLACK_LEVEL, WHITE_LEVEL, ["g"], threads=os.cpu_count()))),
+        ("findBrightestArea", lambda: findBrightestArea(debayered, (areaSize, areaSize))),
+        ("findBrightestArea (coarse 8)", lambda: findBrightestArea(debayered, (areaSize, areaSize), coarseStep=8)),
+        ("flattenImage", lambda: flattenImage(cropped, perfMask)),
+        ("highpass (flat)", lambda: highPassFilterFlat(flattened, 9)),
+        ("highpass (2d, scipy)", lambda: highPassFilter2D(cropped, perfMask, 9, "scipy")),
+        ("highpass (2d, opencv)", lambda: highPassFilter2D(cropped, perfMask, 9, "opencv")),
+        ("highpass (2d, fft)", lambda: highPassFilter2D(cropped, perfMask, 9, "fft")),
+        ("calculateSpeckleContrast", lambda: calculateSpeckleContrast(flattened)),
+        ("calculateProjectionSpeckle", quiet(lambda: calculateProjectionSpeckle(refDebayered, debayered, perforationThreshold=PERFORATION_THRESHOLD)))
+    ]
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Creates a 12-bit Bayer mosaic (uint16, like rawpy's raw_image_visible) of a white screen, so every bayer pattern can be applied to it
+# Smooth illumination falloff * speckle (gamma distributed intensity with the given contrast) with a grid of dark perforations
+def createSyntheticRawImage(shape, speckleContrast=SPECKLE_CONTRAST, seed=0, perforationPitch=60):
+    rng = np.random.default_rng(seed)
+    height, width = shape
+
+    # Illumination: brightest in the center, 60% at the corners
+    y = np.linspace(-1, 1, height, dtype=np.float32)[:, None]
+    x = np.linspace(-1, 1, width, dtype=np.float32)[None, :]
+    image = 1 - 0.2*(y**2 + x**2)
+
+    # Speckle: the sum of M fully developed speckle patterns has the contrast 1/sqrt(M)
+    if speckleContrast > 0:
+        image *= rng.gamma(1/speckleContrast**2, speckleContrast**2, size=shape).astype(np.float32)
+
+    # Perforations
+    image[perforationPitch//2::perforationPitch, :] *= 0.05
+    image[:, perforationPitch//2::perforationPitch] *= 0.05
+
+    # Scale to the raw range with the mean at 40% of the white level
+    black, white = BLACK_LEVEL[0], WHITE_LEVEL[0]
+    image *= 0.4*(white - black)
+    image += black
+    np.clip(image, 0, white, out=image)
+    return image.astype(np.uint16)
+
+# Imports every module of LIGHTWEIGHT_MODULES in a fresh interpreter and returns the import time and the HEAVY_MODULES it loaded
+def measureImports(modules=LIGHTWEIGHT_MODULES, budget=IMPORT_TIME_BUDGET):
+    script = ("import sys, time, json; start = time.perf_counter(); import {module}; seconds = time.perf_counter() - start; "
+              "print(json.dumps([seconds, [name for name in " + json.dumps(HEAVY_MODULES) + " if name in sys.modules]]))")
+    imports = []
+    for module in modules:
+        output = subprocess.run([sys.executable, "-c", script.format(module=module)], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        seconds, heavyModules = json.loads(output.strip().splitlines()[-1])
+        imports.append({"module": module, "seconds": seconds, "heavyModules": heavyModules,
+                        "withinBudget": seconds <= budget and not heavyModules})
+    return imports
+
+# Runs a stage repeat times and returns the run times, the peak allocated memory of one run and the result
+def measureStage(stageFunction, repeat=3):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stageFunction()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = stageFunction()
+    _, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peakBytes, result
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+# Runs a function without printing the progress messages of the pipeline
+def runQuiet(function):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+def getEnvironment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(), "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def printResults(results):
+    print("{:<6} {:<8} {:<40} {:>10} {:>10} {:>10}".format("MP", "Pattern", "Stage", "min [ms]", "med [ms]", "peak [MB]"))
+    for entry in results["stages"]:
+        print("{:<6} {:<8} {:<40} {:>10.2f} {:>10.2f} {:>10.1f}".format(entry["megapixels"], entry["pattern"], entry["stage"],
+              entry["secondsMin"]*1000, entry["secondsMedian"]*1000, entry["peakBytes"]/1024**2))
+    print("\nContrast (expected / filtered / final):")
+    for entry in results["contrast"]:
+        print("{:<6} {:<8} {:.2f}% / {:.2f}% / {:.2f}%".format(entry["megapixels"], entry["pattern"], entry["expected"], entry["filtered"], entry["final"]))
+
+def printImports(imports):
+    print("\nImport time (budget " + str(IMPORT_TIME_BUDGET*1000) + " ms, heavy modules loaded):")
+    for entry in imports:
+        print("{:<25} {:>8.1f} ms  {:<30} {}".format(entry["module"], entry["seconds"]*1000, ", ".join(entry["heavyModules"]) or "-",
+              "" if entry["withinBudget"] else "OVER BUDGET"))
+
+# Prints the change of the minimal run time and peak memory of every stage compared to a previous run
+def printComparison(previousResults, results):
+    key = lambda entry: (entry["megapixels"], entry["pattern"], entry["stage"])
+    previousStages = {key(entry): entry for entry in previousResults["stages"]}
+
+    print("\nCompared to " + str(previousResults["environment"].get("commit", ""))[:10] + ":")
+    for entry in results["stages"]:
+        previous = previousStages.get(key(entry))
+        if previous is None:
+            continue
+        timeRatio = entry["secondsMin"] / previous["secondsMin"] if previous["secondsMin"] > 0 else float("nan")
+        memoryRatio = entry["peakBytes"] / previous["peakBytes"] if previous["peakBytes"] > 0 else float("nan")
+        print("{:<6} {:<8} {:<40} time x{:.2f}  memory x{:.2f}".format(entry["megapixels"], entry["pattern"], entry["stage"], timeRatio, memoryRatio))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,24 @@
 import numpy
 
 PI = numpy.pi
+# Full f-stops that can be chosen on a lens
+FULL_F_STOPS = [1, 1.4, 2, 2.8, 4, 5.6, 8, 11, 16, 22, 32, 45]
+# Wanted ratio sqrt(pixel area / speckle area)
+WANTED_SQRT_RATIO = 0.54
+EYE_CLEAR_APERTURE = 3.2*10**-3 # Clear aperture of the eye in m
 
 # Calculates the focal length and f-number to choose for measuring speckle
 def calcFNumAndFocalLength(wavelength, pixelWidth, fNumRange=(2.8, 22), focalLenghtRange=(12,60)):
     # Convert to meter
     wavelength /= 10**9 # expected in nanometer
     pixelWidth /= 10**6 # expected in micrometer
-    clearAperture = 3.2*10**-3 # Clear aperture of the eye
+    clearAperture = EYE_CLEAR_APERTURE
 
     fNumMin, fNumMax = fNumRange
     focalLenghtMin, focalLenghtMax = focalLenghtRange
     pixelArea = pixelWidth**2 
  
-    wantedSqrtRatio = 0.54
+    wantedSqrtRatio = WANTED_SQRT_RATIO
     wantedFnum = numpy.sqrt((PI*pixelArea)/(4*wantedSqrtRatio**2*wavelength**2))
     wantedFocalLength = numpy.sqrt((((clearAperture)**2)*PI*pixelArea)/(4*wantedSqrtRatio**2*wavelength**2))*10**3
 
@@ -23,9 +28,8 @@ def calcFNumAndFocalLength(wavelength, pixelWidth, fNumRange=(2.8, 22), focalLen
     print(" > " + str(round(wantedFocalLength, 1)) + "mm")
 
     # Account for possible ranges of focal length and f-number
-    allFNums = [1, 1.4, 2, 2.8, 4, 5.6, 8, 11, 16, 22, 32, 45]
     possibleFnums = []
-    for fNum in allFNums:
+    for fNum in FULL_F_STOPS:
         if fNum >= fNumMin and fNum <= fNumMax:
             possibleFnums.append(fNum)
         else: 
@@ -59,4 +63,66 @@ def calcFNumAndFocalLength(wavelength, pixelWidth, fNumRange=(2.8, 22), focalLen
     print(" > 'Speckle per pixel': " + str(round(pixSpeckRatio,2)))
     print("> clear aperture changed from " + str(round(clearAperture*10**3, 2)) + "mm to " + str(round(newClearAperture*10**3, 2)) + "mm")  
     print(" > for matching the human eye, the aperture diameter should lie between 3-4mm")
-    print("> angular resolution " + str(round(numpy.degrees((1.22*wavelength)/(newClearAperture)), 4)) + "°")
\ No newline at end of file
+    print("> angular resolution " + str(round(numpy.degrees((1.22*wavelength)/(newClearAperture)), 4)) + "°")
+
+# Fields of the structured array returned by calcFNumAndFocalLengthArray() (lengths in nm, µm and mm like the inputs)
+CAMERA_SETTING_FIELDS = [("wavelength", numpy.float64), ("pixelWidth", numpy.float64), ("fNumMin", numpy.float64), ("fNumMax", numpy.float64),
+                         ("focalLengthMin", numpy.float64), ("focalLengthMax", numpy.float64), ("wantedFNum", numpy.float64),
+                         ("wantedFocalLength", numpy.float64), ("fNum", numpy.float64), ("focalLength", numpy.float64), ("sqrtRatio", numpy.float64),
+                         ("specklePerPixel", numpy.float64), ("clearAperture", numpy.float64), ("angularResolution", numpy.float64)]
+
+# Same calculation as calcFNumAndFocalLength() for many configurations at once, nothing is printed
+# wavelengths (nm), pixelWidths (µm), fNumRanges (..., 2) and focalLengthRanges (..., 2, in mm) are broadcast against each other,
+# e.g. wavelengths[:, None] with pixelWidths[None, :] evaluates every combination.
+# Returns a structured array of the broadcast shape with the fields of CAMERA_SETTING_FIELDS (clearAperture in mm, angularResolution in °)
+def calcFNumAndFocalLengthArray(wavelengths, pixelWidths, fNumRanges=(2.8, 22), focalLengthRanges=(12, 60)):
+    wavelengths = numpy.asarray(wavelengths, dtype=numpy.float64)
+    pixelWidths = numpy.asarray(pixelWidths, dtype=numpy.float64)
+    fNumRanges = numpy.asarray(fNumRanges, dtype=numpy.float64)
+    focalLengthRanges = numpy.asarray(focalLengthRanges, dtype=numpy.float64)
+    wavelength, pixelWidth, fNumMin, fNumMax, focalLengthMin, focalLengthMax = numpy.broadcast_arrays(
+        wavelengths, pixelWidths, fNumRanges[..., 0], fNumRanges[..., 1], focalLengthRanges[..., 0], focalLengthRanges[..., 1])
+
+    # Convert to meter
+    wavelengthM = wavelength / 10**9
+    pixelArea = (pixelWidth / 10**6)**2
+    clearAperture = EYE_CLEAR_APERTURE
+
+    wantedFnum = numpy.sqrt((PI*pixelArea)/(4*WANTED_SQRT_RATIO**2*wavelengthM**2))
+    wantedFocalLength = numpy.sqrt(((clearAperture**2)*PI*pixelArea)/(4*WANTED_SQRT_RATIO**2*wavelengthM**2))*10**3
+
+    # Closest f-stop in range, f-stops out of range count as fNumMin (the first of equally close f-stops wins)
+    fStops = numpy.array(FULL_F_STOPS, dtype=numpy.float64)
+    inRange = (fStops >= fNumMin[..., None]) & (fStops <= fNumMax[..., None])
+    possibleFnums = numpy.where(inRange, fStops, fNumMin[..., None])
+    bestFnum = numpy.take_along_axis(possibleFnums, numpy.argmin(numpy.abs(possibleFnums - wantedFnum[..., None]), axis=-1)[..., None], axis=-1)[..., 0]
+
+    newSpeckleArea = (4*wavelengthM**2*bestFnum**2)/PI
+    newSqrtRatio = numpy.sqrt(pixelArea/newSpeckleArea)
+    pixSpeckRatio = pixelArea/newSpeckleArea
+    recalibratedFocalLength = numpy.sqrt(((clearAperture**2)*PI*pixelArea)/(4*newSqrtRatio**2*wavelengthM**2))*10**3 # in mm
+
+    # Closest focal length in 1 mm steps from focalLengthMin (like numpy.arange(min, max+1)), the shorter one wins on a tie
+    focalLengthSteps = numpy.ceil(focalLengthMax + 1 - focalLengthMin) - 1
+    bestFocalLength = focalLengthMin + numpy.clip(numpy.ceil(recalibratedFocalLength - focalLengthMin - 0.5), 0, focalLengthSteps)
+
+    newClearAperture = numpy.where(recalibratedFocalLength == bestFocalLength, clearAperture,
+                                   numpy.sqrt(((bestFocalLength*10**-3)**2*4*newSqrtRatio**2*wavelengthM**2)/(PI*pixelArea))) # in m
+
+    settings = numpy.empty(wavelength.shape, dtype=CAMERA_SETTING_FIELDS)
+    settings["wavelength"], settings["pixelWidth"] = wavelength, pixelWidth
+    settings["fNumMin"], settings["fNumMax"] = fNumMin, fNumMax
+    settings["focalLengthMin"], settings["focalLengthMax"] = focalLengthMin, focalLengthMax
+    settings["wantedFNum"], settings["wantedFocalLength"] = wantedFnum, wantedFocalLength
+    settings["fNum"], settings["focalLength"] = bestFnum, bestFocalLength
+    settings["sqrtRatio"], settings["specklePerPixel"] = newSqrtRatio, pixSpeckRatio
+    settings["clearAperture"] = newClearAperture*10**3
+    settings["angularResolution"] = numpy.degrees((1.22*wavelengthM)/newClearAperture)
+    return settings
+
+# Returns the settings (flattened) sorted by the deviation of the sqrt ratio from WANTED_SQRT_RATIO,
+# equally good settings by the deviation of the clear aperture from the eye's
+def rankCameraSettings(settings):
+    settings = numpy.ravel(settings)
+    order = numpy.lexsort((numpy.abs(settings["clearAperture"] - EYE_CLEAR_APERTURE*10**3), numpy.abs(settings["sqrtRatio"] - WANTED_SQRT_RATIO)))
+    return settings[order]
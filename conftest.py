@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are flat files in the repository root, make them importable for the tests in tests/
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,108 @@
+import numpy as np
+from speckleCore import sumAllAreas
+from speckleCalculator import loadImageChannel, findPerforations
+from rawProcessor import getPrecision
+from stageProfiler import profileStage
+
+'''
+Speckle contrast map over the whole image, e.g. to check the uniformity of a screen.
+The contrast (std / mean in %, like calculateSpeckleContrast()) is calculated for every window of windowSize,
+either sliding pixel by pixel or in tiles (step = windowSize). The window sums of I, I² and of the unmasked pixels
+are taken from integral images, so the cost doesn't depend on the window size.
+Masked pixels (perforations) don't contribute, windows with too few unmasked pixels are NaN in the map.
+The contrast is calculated on the unfiltered pixels, the window acts as the highpass of calculateProjectionSpeckle().
+'''
+
+# Windows with less than this fraction of unmasked pixels get no contrast value
+MIN_VALID_FRACTION = 0.5
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+# Loads the image (and the perforation mask from the reference) and calculates its contrast map, see calculateContrastMap()
+# Returns the contrast map and its summary, see getContrastMapSummary()
+# precision and bitDepth are used for loading the images like in speckleCalculator.analyzeImage()
+def analyzeContrastMap(path, refName, imgName, datatype, useRefImg=True, debayerChannel="g", windowSize=64, step=None, perforationThreshold=None, useCache=True, precision="uint8", bitDepth=None):
+    print("__________________")
+    print("Calculating contrast map of '"+ imgName + "' " + "[" + datatype + "]" + "...")
+
+    imgPath = path + imgName + "." + datatype
+    with profileStage("load image"):
+        img = loadImageChannel(imgPath, datatype, debayerChannel, useCache, precision, bitDepth)
+    if img is None:
+        raise Exception(" ! Image '" + imgPath + "' couldn't be loaded.")
+
+    perfMask = None
+    if useRefImg:
+        refPath = path + refName + "." + datatype
+        with profileStage("load reference"):
+            refImg = loadImageChannel(refPath, datatype, debayerChannel, useCache, precision, bitDepth)
+        if refImg is None:
+            raise Exception(" ! Image '" + refPath + "' couldn't be loaded.")
+        print(" > Generating perforation mask")
+        with profileStage("perforation mask"):
+            perfMask = findPerforations(refImg, perforationThreshold, getPrecision(precision, bitDepth)[1])
+
+    print(" > Calculating contrast of " + str(windowSize) + "x" + str(windowSize) + " windows")
+    contrastMap = calculateContrastMap(img, windowSize, step, perfMask)
+    summary = getContrastMapSummary(contrastMap)
+    print(" > Contrast: mean {:.2f}%, min {:.2f}%, max {:.2f}% ({:.0%} of the windows valid)".format(
+          summary["mean"], summary["min"], summary["max"], summary["validFraction"]))
+    return contrastMap, summary
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Returns the speckle contrast (in %) of every window as float32 map, the value at [y, x] belongs to the window starting at (y*step, x*step)
+# step None slides the window pixel by pixel, step = windowSize gives non-overlapping tiles
+# Pixels where the mask is 0 are left out, windows with less than minValidFraction unmasked pixels are NaN
+def calculateContrastMap(img, windowSize=64, step=None, mask=None, minValidFraction=MIN_VALID_FRACTION):
+    import cv2
+    img = np.asarray(img)
+    windowHeight, windowWidth = (windowSize, windowSize) if np.isscalar(windowSize) else windowSize
+    if img.shape[0] < windowHeight or img.shape[1] < windowWidth:
+        raise Exception(" ! The window " + str((windowHeight, windowWidth)) + " is larger than the image " + str(img.shape) + ".")
+    step = 1 if step is None else int(step)
+
+    # cv2.integral() takes 8 bit or float images
+    if img.dtype not in (np.uint8, np.float32, np.float64):
+        img = img.astype(np.float32)
+
+    with profileStage("contrast map"):
+        if mask is None:
+            pixelCounts = np.float64(windowHeight * windowWidth)
+        else:
+            maskSelection = (np.asarray(mask) > 0).view(np.uint8)
+            img = img * maskSelection.astype(img.dtype, copy=False)
+            pixelCounts = sumAllAreas(cv2.integral(maskSelection, sdepth=cv2.CV_32S), windowWidth, windowHeight, step).astype(np.float64)
+
+        integralImage, squaredIntegralImage = cv2.integral2(img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        windowSums = sumAllAreas(integralImage, windowWidth, windowHeight, step)
+        squaredWindowSums = sumAllAreas(squaredIntegralImage, windowWidth, windowHeight, step)
+
+        # std/mean = sqrt(n*sum(I²) - sum(I)²) / sum(I), windows without enough pixels (or without light) are NaN
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variances = squaredWindowSums * pixelCounts
+            variances -= windowSums * windowSums
+            np.maximum(variances, 0, out=variances)
+            contrastMap = np.sqrt(variances, out=variances)
+            contrastMap /= windowSums
+            contrastMap *= 100
+        contrastMap[(pixelCounts < minValidFraction * windowHeight * windowWidth) | (windowSums <= 0)] = np.nan
+    return contrastMap.astype(np.float32)
+
+# Returns summary statistics of a contrast map (NaN windows are left out)
+def getContrastMapSummary(contrastMap):
+    validValues = contrastMap[np.isfinite(contrastMap)].astype(np.float64)
+    summary = {"windows": int(contrastMap.size), "validFraction": validValues.size / contrastMap.size if contrastMap.size else 0.0}
+    if validValues.size == 0:
+        return dict(summary, mean=np.nan, std=np.nan, min=np.nan, max=np.nan, median=np.nan, p5=np.nan, p95=np.nan, uniformity=np.nan)
+
+    p5, median, p95 = np.percentile(validValues, [5, 50, 95])
+    summary.update(mean=float(validValues.mean()), std=float(validValues.std()), min=float(validValues.min()), max=float(validValues.max()),
+                   median=float(median), p5=float(p5), p95=float(p95))
+    # Uniformity: lowest / highest contrast, 1 for a perfectly uniform screen
+    summary["uniformity"] = summary["min"] / summary["max"] if summary["max"] > 0 else np.nan
+    return summary
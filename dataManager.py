@@ -3,15 +3,33 @@ import csv
 import os
 import datetime
 import sys
+import json
+import uuid
+import sqlite3
 
 scriptDir = os.path.dirname(__file__)
-CSV_PATH = scriptDir + "\\csvFiles\\"
+CSV_PATH = os.path.join(scriptDir, "csvFiles")
+
+# Columns of the result tables written by ResultSink
+# Further scalar results and metadata are stored as json in "extra", pixel arrays in the .npz file named in "arrays"
+RESULT_FIELDS = ["fi_ref_speck", "raw_speck", "fi_speck", "dif_speck"]
+METADATA_FIELDS = ["color", "distance", "fLen", "aperture", "iso", "shutter", "projInFocus", "camera"]
+RESULT_COLUMNS = ["resultID", "dateID", "name", "datatype", "path"] + RESULT_FIELDS + METADATA_FIELDS + ["extra", "arrays"]
+NUMERIC_COLUMNS = RESULT_FIELDS + ["distance", "fLen", "aperture", "iso", "shutter"]
+# Columns of a ResultStore with an index (queries on them don't scan the table)
+INDEXED_COLUMNS = ["dateID", "name", "color", "camera", "aperture", "iso", "distance"]
+# Result tables with this extension are written to a ResultStore (SQLite) instead of a csv file, see openResultSink()
+RESULT_STORE_EXTENSION = ".db"
+
+# Returns the path of a file of the result table fileName in CSV_PATH (fileName can contain subfolders)
+def getResultFilePath(fileName, suffix=".csv"):
+    return os.path.join(CSV_PATH, fileName + suffix)
 
 def getCurrentTime():
     return datetime.datetime.now().isoformat()
 
 def appendToCSV(data, fileName):
-    filePath =  CSV_PATH + fileName + ".csv"
+    filePath =  getResultFilePath(fileName, ".csv")
     fileExists = os.path.isfile(filePath)
 
     with open(filePath, "a", newline="") as file:
@@ -23,6 +41,7 @@ def appendToCSV(data, fileName):
 
         writer.writerows(data)
 
+# Reads a complete csv file in the legacy format (see appendToCSV()), use iterateResults() for tables written by ResultSink
 def readCSV(fileName):
     maxInt = sys.maxsize
     while True:
@@ -34,10 +53,234 @@ def readCSV(fileName):
         except OverflowError:
             maxInt = int(maxInt/10)
 
-    filePath =  CSV_PATH + fileName + ".csv"
+    filePath =  getResultFilePath(fileName, ".csv")
     with open(filePath, "r", newline="") as file:
         reader = csv.reader(file)
         data = [row for row in reader]
 
     # Delete header
-    return np.array(data[1:])
\ No newline at end of file
+    return np.array(data[1:])
+
+# Writes results to a compact csv table (one row of scalars per result) and stores the pixel arrays as .npz files next to it
+# Rows are buffered and written every bufferSize results and on flush()/close(). Can be used as a context manager.
+class ResultSink:
+    def __init__(self, fileName, bufferSize=32):
+        self.filePath = getResultFilePath(fileName, ".csv")
+        self.arrayDir = getResultFilePath(fileName, "_arrays")
+        self.bufferSize = bufferSize
+        self.buffer = []
+
+        if os.path.isfile(self.filePath):
+            with open(self.filePath, "r", newline="") as file:
+                header = next(csv.reader(file), [])
+            if header and header != RESULT_COLUMNS:
+                raise Exception(" ! '" + self.filePath + "' has a different format. Use a new file name for the result table.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    # Adds a result, pixel arrays (numpy arrays in results) are written to the sidecar file right away
+    def write(self, results, imgData={}, metadata={}):
+        row = createResultRow(results, imgData, metadata, self.arrayDir)
+        self.buffer.append(row)
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+        return row["resultID"]
+
+    # Appends the buffered rows to the csv table
+    def flush(self):
+        if not self.buffer:
+            return
+        os.makedirs(os.path.dirname(self.filePath), exist_ok=True)
+        fileExists = os.path.isfile(self.filePath)
+        with open(self.filePath, "a", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=RESULT_COLUMNS)
+            if not fileExists:
+                writer.writeheader()
+            writer.writerows(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+# Stores results in an indexed SQLite database (one row per result, columns like RESULT_COLUMNS), pixel arrays as .npz files next to it
+# Rows are buffered like in ResultSink and inserted in one transaction. INDEXED_COLUMNS are indexed, see queryResults() for reading.
+class ResultStore(ResultSink):
+    def __init__(self, fileName, bufferSize=32):
+        self.filePath = getResultStorePath(fileName)
+        self.arrayDir = getResultFilePath(stripStoreExtension(fileName), "_arrays")
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.connection = connectResultStore(self.filePath)
+
+    # Inserts the buffered rows
+    def flush(self):
+        if not self.buffer:
+            return
+        placeholders = ", ".join("?" for _ in RESULT_COLUMNS)
+        with self.connection:
+            self.connection.executemany("INSERT INTO results VALUES (" + placeholders + ")",
+                                        [[toSqlValue(row.get(column)) for column in RESULT_COLUMNS] for row in self.buffer])
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+# Returns a ResultStore for file names ending with RESULT_STORE_EXTENSION, a ResultSink (csv) otherwise
+def openResultSink(fileName, bufferSize=32):
+    if fileName.endswith(RESULT_STORE_EXTENSION):
+        return ResultStore(fileName, bufferSize)
+    return ResultSink(fileName, bufferSize)
+
+# Returns the rows of a ResultStore matching all filters as dicts with the requested columns (all columns if None)
+# Filters are column=value, a list or tuple of values matches any of them. since/until limit the dateID (iso format, until is exclusive).
+# Only the matching rows and columns are read from the database. "extra" is returned as dict.
+def queryResults(fileName, columns=None, since=None, until=None, orderBy="dateID", **filters):
+    columns = RESULT_COLUMNS if columns is None else list(columns)
+    for column in columns + list(filters) + [orderBy]:
+        if column not in RESULT_COLUMNS:
+            raise Exception(" ! '" + str(column) + "' is not a column of the result store. Use one of " + str(RESULT_COLUMNS) + ".")
+
+    conditions = []
+    parameters = []
+    for column, value in filters.items():
+        if isinstance(value, (list, tuple)):
+            conditions.append(column + " IN (" + ", ".join("?" for _ in value) + ")")
+            parameters.extend(toSqlValue(item) for item in value)
+        elif value is None:
+            conditions.append(column + " IS NULL")
+        else:
+            conditions.append(column + " = ?")
+            parameters.append(toSqlValue(value))
+    if since is not None:
+        conditions.append("dateID >= ?")
+        parameters.append(str(since))
+    if until is not None:
+        conditions.append("dateID < ?")
+        parameters.append(str(until))
+
+    query = "SELECT " + ", ".join(columns) + " FROM results"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + orderBy
+
+    connection = connectResultStore(getResultStorePath(fileName))
+    try:
+        rows = [dict(zip(columns, values)) for values in connection.execute(query, parameters)]
+    finally:
+        connection.close()
+    for row in rows:
+        if "extra" in row:
+            row["extra"] = json.loads(row["extra"]) if row["extra"] else {}
+    return rows
+
+# Adds the rows of a csv result table (written by ResultSink) to a ResultStore, rows that are already in the store are skipped
+# The pixel arrays stay in the sidecar folder of the csv table. Returns the number of added rows.
+def importResultTable(csvFileName, storeFileName, batchSize=1000):
+    placeholders = ", ".join("?" for _ in RESULT_COLUMNS)
+    connection = connectResultStore(getResultStorePath(storeFileName))
+    addedRows = 0
+    try:
+        with open(getResultFilePath(csvFileName, ".csv"), "r", newline="") as file:
+            reader = csv.DictReader(file)
+            while True:
+                rows = [row for _, row in zip(range(batchSize), reader)]
+                if not rows:
+                    break
+                with connection:
+                    cursor = connection.executemany("INSERT OR IGNORE INTO results VALUES (" + placeholders + ")",
+                                                    [[parseNumber(row[column]) if column in NUMERIC_COLUMNS else (row[column] or None) for column in RESULT_COLUMNS] for row in rows])
+                    addedRows += cursor.rowcount
+    finally:
+        connection.close()
+    return addedRows
+
+# Streams the rows of a result table written by ResultSink one by one as dicts.
+# Numeric columns are converted to float. The pixel arrays are only loaded with loadArrays (as dict in "arrays").
+def iterateResults(fileName, loadArrays=False):
+    filePath = getResultFilePath(fileName, ".csv")
+    arrayDir = getResultFilePath(fileName, "_arrays")
+    with open(filePath, "r", newline="") as file:
+        for row in csv.DictReader(file):
+            for key in NUMERIC_COLUMNS:
+                row[key] = parseNumber(row[key])
+            row["extra"] = json.loads(row["extra"]) if row["extra"] else {}
+            if loadArrays and row["arrays"]:
+                with np.load(os.path.join(arrayDir, row["arrays"])) as arrays:
+                    row["arrays"] = {key: arrays[key] for key in arrays.files}
+            yield row
+
+# Builds the row of a result table, pixel arrays (numpy arrays in results) are written to arrayDir as <resultID>.npz
+def createResultRow(results, imgData={}, metadata={}, arrayDir=None):
+    resultID = uuid.uuid4().hex[:16]
+    row = {"resultID": resultID, "dateID": getCurrentTime()}
+    row.update({key: imgData.get(key, "") for key in ["name", "datatype", "path"]})
+    extra = {}
+    arrays = {}
+
+    for key, value in results.items():
+        if isinstance(value, np.ndarray):
+            arrays[key] = value
+        elif key in RESULT_FIELDS:
+            row[key] = value
+        elif value is not None:
+            extra[key] = value
+    for key, value in metadata.items():
+        if key in METADATA_FIELDS:
+            row[key] = value
+        else:
+            extra[key] = value
+
+    if arrays:
+        os.makedirs(arrayDir, exist_ok=True)
+        np.savez(os.path.join(arrayDir, resultID + ".npz"), **arrays)
+        row["arrays"] = resultID + ".npz"
+    row["extra"] = json.dumps(extra, default=toJsonValue) if extra else ""
+    return row
+
+# Opens (and creates) the SQLite database of a ResultStore
+def connectResultStore(filePath):
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    connection = sqlite3.connect(filePath)
+    columnTypes = {column: " REAL" if column in NUMERIC_COLUMNS else "" for column in RESULT_COLUMNS}
+    columnTypes["resultID"] = " TEXT PRIMARY KEY"
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS results (" + ", ".join(column + columnTypes[column] for column in RESULT_COLUMNS) + ")")
+        for column in INDEXED_COLUMNS:
+            connection.execute("CREATE INDEX IF NOT EXISTS results_" + column + " ON results (" + column + ")")
+    return connection
+
+def getResultStorePath(fileName):
+    return getResultFilePath(stripStoreExtension(fileName), RESULT_STORE_EXTENSION)
+
+def stripStoreExtension(fileName):
+    return fileName[:-len(RESULT_STORE_EXTENSION)] if fileName.endswith(RESULT_STORE_EXTENSION) else fileName
+
+# Converts numpy values for SQLite
+def toSqlValue(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=toJsonValue)
+    return value
+
+# Converts a csv value to float, empty values to None
+def parseNumber(value):
+    if value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+# Converts numpy values for json
+def toJsonValue(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
@@ -1,10 +1,12 @@
 from speckleCalculator import analyzeImage, analyzeSingleMeasurement, analyzeMeasurementBatch
-from cameraSettingCalculator import calcFNumAndFocalLength
+from cameraSettingCalculator import calcFNumAndFocalLength, calcFNumAndFocalLengthArray, rankCameraSettings
+from contrastMap import analyzeContrastMap
+from frameStack import analyzeImageStack
 from rawProcessor import RAW_FORMATS
 import os
 
 scriptDir = os.path.dirname(__file__)
-path = scriptDir + "\\img\\dataset1\\"
+path = os.path.join(scriptDir, "img", "dataset1", "") # Ends with a separator, the image names are appended to it
 
 '''
 Format of single measurement to be used with analyzeSingleMeasurement(MEASUREMENT) 
@@ -13,10 +15,21 @@ measurement = {
         "path": "PATH TO IMAGE",
         "refName": "NAME_OF_REF",   // w/o datatype
         "imgName": "NAME_OF_SPECK",     // w/o datatype
-        "datatype": "RW2",  // currently implemented: RW2, CR2, JPG/PNG
+        "datatype": "RW2",  // currently implemented: RW2, CR2, JPG/PNG/TIFF (8 or 16 bit), npy (precomputed debayered arrays, memory mapped)
         "useRefImg": True,  // disable if no reference is used
-        "debayerChannel": "g",  // channel to debayer as one letter string
-        "saveFileName": "FILE TO SAVE CSV WITH RESULTS TO",     // leave empty if unwanted
+        "debayerChannel": "g",  // channel to debayer as one letter string, or a list like ["r", "g", "b"] to analyze several channels of one image
+        "saveFileName": "FILE TO SAVE CSV WITH RESULTS TO",     // leave empty if unwanted, end with ".db" for an indexed SQLite store (query it with dataManager.queryResults())
+        "perforationThreshold": 30,     // optional: fixed threshold or "otsu"/"valley", leave out to choose it with the slider
+        "filterMode": "flat",   // optional: "flat" or "2d" highpass filter
+        "filterBackend": "scipy",   // optional: "scipy", "opencv" or "fft" (only for "2d")
+        "useCache": True,   // optional: cache processed RAW frames on disk (see rawCache.py)
+        "profile": False,   // optional: add time and memory of every stage to the results (see stageProfiler.py)
+        "cropFirst": False,   // optional: only normalize and debayer the analyzed area of RAW images
+        "precision": "uint8",   // optional: "uint8" (0-255), "uint16" (keeps the sensor's dynamic range) or "float32" for all processed images
+        "bitDepth": None,   // optional: bit depth of the normalized values, leave out for the default of the precision
+        "rawThreads": 4,   // optional: threads normalizing and debayering a RAW image in bands, leave out for rawProcessor.RAW_PROCESSING_THREADS
+        "tileRows": 256,   // optional: rows per band of the multi-threaded RAW processing, leave out for rawProcessor.TILE_ROWS
+        "coarseStep": 1,   // optional: > 1 searches the brightest area coarse-to-fine (faster on large sensors, may miss the exact maximum)
         "metadata": {
                 "distance": 1.2, // in m
                 "fLen": 18,
@@ -29,6 +42,11 @@ measurement = {
     }
 '''
 
+# Batches can also be run from the command line with a json or csv manifest of measurements, interrupted runs are resumed:
+# python batchRunner.py measurements.json --workers 4 --perforation-threshold 30 --save-file results
+# Measurements can be analyzed while they arrive with the asyncio API (see asyncPipeline.py), results are yielded as they complete:
+# async for measurement, results in analyzeStream(measurementSource, workers=4, perforationThreshold=30, waitForFiles=True): ...
+
 # Example of analyzeSingleMeasurement() and analyzeMeasurementBatch()
 measurement = {
         "path": path,
@@ -50,6 +68,7 @@ measurement = {
 
 analyzeSingleMeasurement(measurement)
 # analyzeMeasurementBatch([measurement, measurement])
+# analyzeMeasurementBatch([measurement, measurement], workers=4, perforationThreshold=30) # Parallel, needs a fixed threshold
 
 
 # Example for manual usage of analyzeImage()
@@ -59,10 +78,24 @@ analyzeImage(path, "06-09-green-01-ref", "06-09-green-01-speck", RAW_FORMATS["PA
              metadata={"aperture": 11.0, "fLen": 18,"shutter": 0.05, "iso": 800, "distance": 1.0, "projInFocus": False, "camera": "LUMIX G7"})
 analyzeImage(path, "06-09-blue-01-ref", "06-09-blue-01-speck", RAW_FORMATS["PANASONIC"], debayerChannel="b",
              metadata={"aperture": 11.0, "fLen": 18,"shutter": 0.1, "iso": 800, "distance": 1.0, "projInFocus": False, "camera": "LUMIX G7"})
+# All channels of a single (white light) capture, the RAW file is decoded once. Returns the results per channel.
+# analyzeImage(path, "06-09-white-01-ref", "06-09-white-01-speck", RAW_FORMATS["PANASONIC"], debayerChannel=["r", "g", "b"],
+#              metadata={"aperture": 11.0, "fLen": 18,"shutter": 0.1, "iso": 800, "distance": 1.0, "projInFocus": False, "camera": "LUMIX G7"})
+
+# Example of analyzeContrastMap(): contrast of 64x64 tiles over the whole image, e.g. to check the uniformity of the screen
+# contrastMap, summary = analyzeContrastMap(path, "06-09-green-01-ref", "06-09-green-01-speck", RAW_FORMATS["PANASONIC"], debayerChannel="g",
+#                                           windowSize=64, step=64, perforationThreshold=30)
+
+# Example of analyzeImageStack(): several frames of the same setting with a shared crop and perforation mask (see frameStack.py)
+# stackResults = analyzeImageStack(path, "06-09-green-01-ref", ["06-09-green-01-speck", "06-09-green-02-speck", "06-09-green-03-speck"],
+#                                  RAW_FORMATS["PANASONIC"], debayerChannel="g", perforationThreshold=30)
 
 # Example of calcFNumAndFocalLength()
 wavelength = 550
 cameraPixelWidth = 3.75 # in micrometer
 cameraApertureRange = (2.8, 22)
 cameraFocalLengthRange = (12, 60)
-calcFNumAndFocalLength(wavelength, cameraPixelWidth, cameraApertureRange, cameraFocalLengthRange) # LUMIX G7 with 12-60mm, f/2.8-f/22
\ No newline at end of file
+calcFNumAndFocalLength(wavelength, cameraPixelWidth, cameraApertureRange, cameraFocalLengthRange) # LUMIX G7 with 12-60mm, f/2.8-f/22
+# Example of calcFNumAndFocalLengthArray(): every wavelength from 400-700 nm for two cameras, ranked by the resulting sqrt ratio
+# settings = calcFNumAndFocalLengthArray(numpy.arange(400, 701)[:, None], [3.75, 4.3], cameraApertureRange, cameraFocalLengthRange)
+# bestSettings = rankCameraSettings(settings)[:10]
\ No newline at end of file
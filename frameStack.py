@@ -0,0 +1,173 @@
+import numpy as np
+import imageLoader
+from speckleCalculator import loadImageChannel, calculateProjectionSpeckle, calculateReferenceSpeckle, saveResults
+from speckleCore import findBrightestArea, cropImage, getCropSize
+from rawProcessor import getPrecision
+from stageProfiler import profileStage
+
+'''
+Analysis of a stack of speckle frames of the same projector setting with one reference, e.g. to average out sensor noise.
+The brightest area is searched in the first frame, the crop location and the perforation mask (from the reference) are used for all frames.
+The frames are processed one after another in a single pass: only the current frame and running statistics (Welford) of the crop are held in memory,
+so the memory doesn't grow with the number of frames. Reported are:
+- the contrast of every frame (like analyzeImage()) and their mean and standard deviation over the frames
+- the contrast of the mean image of the stack (sensor noise is averaged out), rounded to the type of the frames so it is filtered like them
+- the temporal contrast: standard deviation / mean of every pixel over the frames, averaged over the unmasked pixels
+'''
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+# Analyzes a stack of speckle frames, imgNames is a list of image names or the name of a stack file (.npy or multi-page TIFF, see imageLoader.loadImageStackChannel())
+# The stack-mean results are stored as "raw_speck", "fi_speck" and "dif_speck", so a stack is saved as a single row like an image (see speckleCalculator.saveResults())
+def analyzeImageStack(path, refName, imgNames, datatype, useRefImg=True, debayerChannel="g", metadata={}, saveFileName=None, filterMode="flat", filterBackend="scipy",
+                      perforationThreshold=None, useCache=True, precision="uint8", bitDepth=None, resultSinks=None):
+    stackName = imgNames if isinstance(imgNames, str) else imgNames[0] + "-stack"
+    print("__________________")
+    print("Analyzing stack '" + stackName + "' " + "[" + datatype + "]" + "...")
+    _, whiteValue = getPrecision(precision, bitDepth)
+
+    refImg = None
+    if useRefImg:
+        refPath = path + refName + "." + datatype
+        with profileStage("load reference"):
+            refImg = loadImageChannel(refPath, datatype, debayerChannel, useCache, precision, bitDepth)
+        if refImg is None:
+            raise Exception(" ! Image '" + refPath + "' couldn't be loaded.")
+
+    frames = iterateStackFrames(path, imgNames, datatype, debayerChannel, useCache, precision, bitDepth)
+    results = calculateStackSpeckle(refImg, frames, useRefImg, filterMode, filterBackend, perforationThreshold, whiteValue)
+
+    if isinstance(saveFileName, str) and saveFileName != "":
+        with profileStage("save results"):
+            saveResults(saveFileName, stackName, datatype, path + stackName + "." + datatype, results, dict(metadata, color=debayerChannel), resultSinks)
+    return results
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Calculates the speckle of every frame (any iterable, frames are only read once) and of the stack with a shared crop and perforation mask
+# Returns the stack results (see analyzeImageStack()) with the per-frame contrasts as lists
+def calculateStackSpeckle(refImage, frames, useRefImg=True, filterMode="flat", filterBackend="scipy", perforationThreshold=None, whiteValue=255):
+    cropFilter = reference = None
+    pixelStatistics = RunningStatistics()
+    frameStatistics = {key: RunningStatistics() for key in ["raw_speck", "fi_speck", "dif_speck"]}
+    frameResults = {key: [] for key in frameStatistics}
+
+    for frameIndex, frame in enumerate(frames):
+        print("\nFrame " + str(frameIndex + 1) + ":")
+        if cropFilter is None:
+            cropSize = getCropSize(np.shape(frame)[1])
+            print(" > Finding brightest area")
+            with profileStage("find brightest area"):
+                cropFilter = findBrightestArea(frame, (cropSize, cropSize))
+            if useRefImg:
+                with profileStage("reference speckle"):
+                    reference = calculateReferenceSpeckle(cropImage(refImage, cropFilter), perforationThreshold, filterMode, filterBackend, whiteValue=whiteValue)
+        elif np.shape(frame) != frameShape:
+            raise Exception(" ! Frame " + str(frameIndex + 1) + " has the shape " + str(np.shape(frame)) + ", the stack started with " + str(frameShape) + ".")
+        frameShape = np.shape(frame)
+
+        results = calculateProjectionSpeckle(None, frame, useRefImg, filterMode, filterBackend, cropSize=cropSize, cropFilter=cropFilter,
+                                             referenceProvider=lambda _: reference, whiteValue=whiteValue)
+        for key in frameResults:
+            frameResults[key].append(results[key])
+            frameStatistics[key].update(results[key])
+        with profileStage("stack statistics"):
+            pixelStatistics.update(cropImage(frame, cropFilter))
+
+    if cropFilter is None:
+        raise Exception(" ! The stack doesn't contain any frames.")
+
+    # Contrast of the mean image, calculated like the contrast of a single frame on its whole area
+    # The mean image is rounded to the type of the frames, so it takes the same highpass path (e.g. the uint8 lowpass of the "flat" mode)
+    print("\nStack mean (" + str(pixelStatistics.count) + " frames):")
+    meanImage = getMeanImage(pixelStatistics, frame.dtype)
+    meanResults = calculateProjectionSpeckle(None, meanImage, useRefImg, filterMode, filterBackend, cropSize=cropSize, cropFilter=[0, 0, cropSize, cropSize],
+                                             referenceProvider=lambda _: reference, whiteValue=whiteValue)
+
+    perfMask = reference[0] if useRefImg else None
+    temporalSpeckle = calculateTemporalContrast(pixelStatistics, perfMask)
+    print(" > Temporal contrast: {:.2f}%".format(temporalSpeckle))
+
+    results = dict(meanResults)
+    results.update({"frames": pixelStatistics.count, "temporal_speck": temporalSpeckle})
+    for key, statistics in frameStatistics.items():
+        results["frame_" + key] = frameResults[key]
+        results["frame_" + key + "_mean"] = float(statistics.mean)
+        results["frame_" + key + "_std"] = float(statistics.std())
+    return results
+
+# Returns the mean temporal contrast (std / mean over the frames in %) of the unmasked pixels, NaN for less than 2 frames
+def calculateTemporalContrast(pixelStatistics, mask=None):
+    if pixelStatistics.count < 2:
+        return np.nan
+    mean = pixelStatistics.mean
+    validPixels = mean > 0
+    if mask is not None:
+        validPixels &= np.asarray(mask) > 0
+    temporalContrast = np.sqrt(pixelStatistics.variance()[validPixels]) / mean[validPixels] * 100
+    return float(np.mean(temporalContrast)) if temporalContrast.size else np.nan
+
+# Running mean and variance of scalars or arrays of the same shape (Welford's algorithm, float64)
+class RunningStatistics:
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.squaredDeviations = None
+
+    def update(self, value):
+        value = np.asarray(value, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = value.copy()
+            self.squaredDeviations = np.zeros_like(self.mean)
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        delta *= value - self.mean
+        self.squaredDeviations += delta
+
+    # Population variance (like np.var), ddof=1 for the sample variance
+    def variance(self, ddof=0):
+        if self.count - ddof <= 0:
+            return np.full_like(self.mean, np.nan) if self.mean is not None else np.nan
+        return self.squaredDeviations / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+# Returns the mean of the running statistics in the given image type, integer types are rounded and clipped to their range
+def getMeanImage(pixelStatistics, imageType):
+    imageType = np.dtype(imageType)
+    if not np.issubdtype(imageType, np.integer):
+        return pixelStatistics.mean.astype(imageType)
+    typeInfo = np.iinfo(imageType)
+    return np.clip(np.rint(pixelStatistics.mean), typeInfo.min, typeInfo.max).astype(imageType)
+
+# Yields the frames of a stack one after another: the images of a list of names or the frames of a stack file
+# A .npy stack is memory mapped, the pages of a multi-page TIFF are decoded one at a time (see imageLoader.iterateImageStackChannel())
+def iterateStackFrames(path, imgNames, datatype, debayerChannel="g", useCache=True, precision="uint8", bitDepth=None):
+    if isinstance(imgNames, str):
+        filePath = path + imgNames + "." + datatype
+        frames = imageLoader.iterateImageStackChannel(filePath, datatype, debayerChannel, precision, bitDepth)
+        while True:
+            with profileStage("load frame"):
+                frame = next(frames, None)
+            if frame is None:
+                return
+            yield frame
+
+    for imgName in imgNames:
+        imgPath = path + imgName + "." + datatype
+        with profileStage("load image"):
+            frame = loadImageChannel(imgPath, datatype, debayerChannel, useCache, precision, bitDepth)
+        if frame is None:
+            raise Exception(" ! Image '" + imgPath + "' couldn't be loaded.")
+        yield frame
@@ -0,0 +1,133 @@
+import numpy as np
+from rawProcessor import getPrecision
+from stageProfiler import profileStage
+
+'''
+Loading of non-RAW inputs: images (JPG, PNG, 8/16-bit TIFF) and precomputed, already debayered arrays (.npy).
+Only the requested channels are taken from an image and nothing is copied that doesn't have to be:
+.npy files are memory mapped (read only) and a channel of them is a view, a channel of a decoded image is extracted
+into a single plane (cv2.extractChannel) instead of splitting all planes. The speckle calculation only copies the crop.
+A copy of the whole image is only made if its type or range differs from the requested precision (see convertToPrecision()).
+'''
+
+# Datatypes (file extensions, case insensitive) of precomputed arrays, loaded with np.load(mmap_mode="r")
+ARRAY_FORMATS = ["npy"]
+# Index of the channels in the last axis: images are decoded as BGR by OpenCV, arrays are expected as RGB
+IMAGE_CHANNEL_ORDER = {"b": 0, "g": 1, "r": 2}
+ARRAY_CHANNEL_ORDER = {"r": 0, "g": 1, "b": 2}
+# White value of the input types, floating point inputs are expected in 0-255 (like the "float32" precision)
+INPUT_WHITE_VALUES = {np.dtype(np.uint8): 255, np.dtype(np.uint16): 65535}
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+# Loads the given channels of an image or array file and converts them to the precision (see rawProcessor.getPrecision())
+# Single channel images (grayscale, 2D arrays) are returned for every channel. Returns a dict with the image per channel, None if the file can't be read.
+def loadImageChannels(filePath, datatype, debayerChannels=("r", "g", "b"), precision="uint8", bitDepth=None):
+    with profileStage("decode"):
+        image, channelOrder = loadImageFile(filePath, datatype)
+    if image is None:
+        return None
+    if image.ndim == 3 and image.shape[2] < 3:
+        raise Exception(" ! '" + filePath + "' has " + str(image.shape[2]) + " channels, use a single channel or an RGB image.")
+    if image.ndim not in (2, 3):
+        raise Exception(" ! '" + filePath + "' has the shape " + str(image.shape) + ", only single images can be analyzed (see loadImageStackChannel()).")
+
+    images = {}
+    for debayerChannel in debayerChannels:
+        with profileStage("extract channel"):
+            images[debayerChannel] = convertToPrecision(getImageChannel(image, debayerChannel, channelOrder), precision, bitDepth)
+    return images
+
+# Loads a channel of a stack of frames: a .npy array (frames, height, width[, channels]) or a multi-page TIFF
+# Returns the frames as (frames, height, width) array in the precision, a view of the memory mapped file for .npy in a matching type
+# With precision None the frames keep the type of the file (convert single frames with convertToPrecision())
+# The pages of a TIFF are decoded and converted one at a time into the preallocated stack
+def loadImageStackChannel(filePath, datatype, debayerChannel="g", precision="uint8", bitDepth=None):
+    if datatype.lower() in ARRAY_FORMATS:
+        stack = np.load(filePath, mmap_mode="r")
+        if stack.ndim == 4:
+            stack = stack[..., ARRAY_CHANNEL_ORDER[debayerChannel.lower()]]
+        elif stack.ndim != 3:
+            raise Exception(" ! '" + filePath + "' has the shape " + str(stack.shape) + ", a stack needs the shape (frames, height, width[, channels]).")
+        return stack if precision is None else convertToPrecision(stack, precision, bitDepth)
+
+    pageCount = getPageCount(filePath)
+    if pageCount == 0:
+        return None
+    stack = None
+    for pageIndex, frame in enumerate(iterateImagePages(filePath, pageCount, debayerChannel, precision, bitDepth)):
+        if stack is None:
+            stack = np.empty((pageCount,) + frame.shape, dtype=frame.dtype)
+        elif frame.shape != stack.shape[1:]:
+            raise Exception(" ! Page " + str(pageIndex + 1) + " of '" + filePath + "' has the shape " + str(frame.shape) + ", the stack started with " + str(stack.shape[1:]) + ".")
+        stack[pageIndex] = frame
+    return stack
+
+# Yields the frames of a stack (see loadImageStackChannel()) one after another in the precision
+# Only one frame is in memory at a time: a .npy stack is memory mapped, the pages of a TIFF are decoded one at a time
+def iterateImageStackChannel(filePath, datatype, debayerChannel="g", precision="uint8", bitDepth=None):
+    if datatype.lower() in ARRAY_FORMATS:
+        for frame in loadImageStackChannel(filePath, datatype, debayerChannel, precision=None):
+            yield convertToPrecision(frame, precision, bitDepth)
+        return
+
+    pageCount = getPageCount(filePath)
+    if pageCount == 0:
+        raise Exception(" ! Stack '" + filePath + "' couldn't be loaded.")
+    yield from iterateImagePages(filePath, pageCount, debayerChannel, precision, bitDepth)
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Returns the image (or memory mapped array) of a file and the order of its channels, (None, None) if it can't be read
+# 16-bit PNG and TIFF files keep their range (IMREAD_ANYDEPTH). Unlike with IMREAD_UNCHANGED the EXIF orientation is applied like by the default flags,
+# so rotated JPGs keep their orientation and width (and therefore the crop size). Alpha channels are dropped.
+def loadImageFile(filePath, datatype):
+    if datatype.lower() in ARRAY_FORMATS:
+        return np.load(filePath, mmap_mode="r"), ARRAY_CHANNEL_ORDER
+
+    import cv2
+    image = cv2.imread(filePath, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+    return image, (IMAGE_CHANNEL_ORDER if image is not None else None)
+
+# Returns a single channel of an image: a memory mapped array as view, a decoded image as a single extracted plane
+def getImageChannel(image, channel, channelOrder=IMAGE_CHANNEL_ORDER):
+    if image.ndim == 2:
+        return image
+    channelIndex = channelOrder[channel.lower()]
+    if isinstance(image, np.memmap):
+        return image[..., channelIndex]
+
+    import cv2
+    return cv2.extractChannel(image, channelIndex)
+
+# Returns the number of pages of a (multi-page) image file, 0 if it can't be read
+def getPageCount(filePath):
+    import cv2
+    try:
+        return cv2.imcount(filePath)
+    except cv2.error:
+        return 0
+
+# Yields a channel of the pages of a multi-page image file, each page is decoded (cv2.imreadmulti() with count=1) and converted on its own
+# With precision None the pages keep the type of the file
+def iterateImagePages(filePath, pageCount, debayerChannel="g", precision="uint8", bitDepth=None):
+    import cv2
+    for pageIndex in range(pageCount):
+        success, pages = cv2.imreadmulti(filePath, start=pageIndex, count=1, flags=cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+        if not success or len(pages) == 0:
+            raise Exception(" ! Page " + str(pageIndex + 1) + " of '" + filePath + "' couldn't be loaded.")
+        frame = getImageChannel(pages[0], debayerChannel, IMAGE_CHANNEL_ORDER)
+        yield frame if precision is None else convertToPrecision(frame, precision, bitDepth)
+
+# Converts an image to the type and range of the precision (see rawProcessor.getPrecision()), the image is returned as it is if it already matches
+def convertToPrecision(img, precision="uint8", bitDepth=None):
+    outputType, whiteValue = getPrecision(precision, bitDepth)
+    inputWhiteValue = INPUT_WHITE_VALUES.get(img.dtype, 255)
+    if img.dtype == outputType and inputWhiteValue == whiteValue:
+        return img
+    with profileStage("convert precision"):
+        return np.multiply(img, np.float32(whiteValue/inputWhiteValue), dtype=np.float32).astype(outputType, copy=False)
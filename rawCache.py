@@ -0,0 +1,118 @@
+import numpy as np
+import hashlib
+import os
+import uuid
+from rawProcessor import processRawFileChannels, getPrecision, RAW_PROCESSOR_VERSION
+from stageProfiler import profileStage
+
+scriptDir = os.path.dirname(__file__)
+CACHE_PATH = os.path.join(scriptDir, "rawCache")
+MAX_CACHE_SIZE = 4 * 1024**3 # in bytes, least recently used frames are removed above this size
+
+'''
+Cache for decoded and debayered RAW frames.
+The frames are stored as .npy files named after the hash of the RAW file, the debayered channel, the precision and RAW_PROCESSOR_VERSION.
+Cached frames are loaded memory mapped (read only). Every access updates the modification time, which is used for the LRU eviction.
+'''
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Returns the processed (normalized and debayered) RAW file from the cache or processes and caches it
+# precision and bitDepth are passed to the raw processing (see rawProcessor.getPrecision()), every precision is cached separately
+# threads and tileRows are passed to the raw processing as well (see rawProcessor.processRawImageChannels()), they don't change the cached frames
+def loadProcessedRawImage(filePath, channelToSeparate="g", cachePath=CACHE_PATH, maxCacheSize=MAX_CACHE_SIZE, precision="uint8", bitDepth=None, threads=None, tileRows=None):
+    return loadProcessedRawImageChannels(filePath, [channelToSeparate], cachePath, maxCacheSize, precision, bitDepth, threads, tileRows)[channelToSeparate]
+
+# Same as loadProcessedRawImage() for several channels. Missing channels are processed with a single decode of the RAW file.
+# Returns a dict with the debayered image per channel.
+def loadProcessedRawImageChannels(filePath, channelsToSeparate=("r", "g", "b"), cachePath=CACHE_PATH, maxCacheSize=MAX_CACHE_SIZE, precision="uint8", bitDepth=None, threads=None, tileRows=None):
+    with profileStage("hash file"):
+        fileHash = getFileHash(filePath)
+
+    images = {}
+    for channelToSeparate in channelsToSeparate:
+        cacheFile = os.path.join(cachePath, getCacheKey(filePath, channelToSeparate, fileHash, precision, bitDepth) + ".npy")
+        if not os.path.isfile(cacheFile):
+            continue
+        try:
+            with profileStage("load cached frame"):
+                images[channelToSeparate] = np.load(cacheFile, mmap_mode="r")
+            os.utime(cacheFile)
+            print(" > Loaded '" + os.path.basename(filePath) + "' (" + channelToSeparate + ") from cache")
+        except (OSError, ValueError):
+            print(" ! Cached frame of '" + os.path.basename(filePath) + "' is damaged and will be replaced")
+
+    missingChannels = [channel for channel in channelsToSeparate if channel not in images]
+    if missingChannels:
+        processedImages = processRawFileChannels(filePath, missingChannels, precision, bitDepth, threads, tileRows)
+        with profileStage("store cached frame"):
+            for channelToSeparate, image in processedImages.items():
+                storeInCache(os.path.join(cachePath, getCacheKey(filePath, channelToSeparate, fileHash, precision, bitDepth) + ".npy"), image)
+            evictCache(cachePath, maxCacheSize)
+        images.update(processedImages)
+
+    return images
+
+# Returns the cache key of a RAW file for the given channel and precision (the file hash can be given if it is already known)
+# The default precision (uint8, 0-255) has no precision part, so frames cached before precisions existed stay valid
+def getCacheKey(filePath, channelToSeparate="g", fileHash=None, precision="uint8", bitDepth=None):
+    if fileHash is None:
+        fileHash = getFileHash(filePath)
+    _, whiteValue = getPrecision(precision, bitDepth)
+    precisionKey = "" if precision == "uint8" and whiteValue == 255 else "-" + precision + "-" + str(whiteValue.bit_length())
+    return fileHash + "-" + channelToSeparate.lower() + precisionKey + "-v" + str(RAW_PROCESSOR_VERSION)
+
+# Removes the least recently used frames until the cache is smaller than maxCacheSize
+def evictCache(cachePath=CACHE_PATH, maxCacheSize=MAX_CACHE_SIZE):
+    if not os.path.isdir(cachePath):
+        return
+
+    cachedFiles = []
+    for entry in os.scandir(cachePath):
+        if entry.is_file() and entry.name.endswith(".npy"):
+            fileStat = entry.stat()
+            cachedFiles.append((fileStat.st_mtime, fileStat.st_size, entry.path))
+
+    cacheSize = sum(size for _, size, _ in cachedFiles)
+    for _, size, path in sorted(cachedFiles):
+        if cacheSize <= maxCacheSize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue # Already removed by another process
+        cacheSize -= size
+
+# Removes all cached frames
+def clearCache(cachePath=CACHE_PATH):
+    evictCache(cachePath, 0)
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+# Returns the hash of a file's content
+def getFileHash(filePath, chunkSize=2**22):
+    fileHash = hashlib.blake2b(digest_size=16)
+    with open(filePath, "rb") as file:
+        while True:
+            chunk = file.read(chunkSize)
+            if not chunk:
+                break
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+# Writes the frame to a temporary file first, so other processes never load a partially written frame
+def storeInCache(cacheFile, image):
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+    tempFile = cacheFile + "." + uuid.uuid4().hex + ".tmp"
+    try:
+        with open(tempFile, "wb") as file:
+            np.save(file, image)
+        os.replace(tempFile, cacheFile)
+    except OSError:
+        print(" ! Frame couldn't be cached: " + cacheFile)
+        if os.path.isfile(tempFile):
+            os.remove(tempFile)
@@ -1,13 +1,33 @@
-import rawpy
 import numpy as np
 import re
 import math
+from concurrent.futures import ThreadPoolExecutor
+from stageProfiler import profileStage
+
+# rawpy is only imported when a RAW file is decoded or checked, so the numeric functions (e.g. for benchmarks) load fast
 
 RED = 0
 GREEN_1 = 1
 BLUE = 2
 GREEN_2 = 3
 
+# Increase when the output of processRawImage() changes, cached frames of older versions are ignored
+RAW_PROCESSOR_VERSION = 3
+
+BGGR_PATTERN = [[BLUE, GREEN_1], [GREEN_2, RED]]
+
+# Precision of the processed images as (type, default bit depth), the normalized white level is 2**bitDepth - 1
+# "uint8": 0-255 like before, "uint16": keeps the dynamic range of 12/14-bit sensors, "float32": 0-255 with the fractional part
+PRECISIONS = {
+    "uint8": (np.uint8, 8),
+    "uint16": (np.uint16, 16),
+    "float32": (np.float32, 8)
+    }
+
+# Tiled processing (see processBayerImageTiled()): threads and BGGR rows per band used by processRawImageChannels() if none are given
+RAW_PROCESSING_THREADS = 1
+TILE_ROWS = 256
+
 # Supported raw types
 RAW_FORMATS = {
     "PANASONIC": "RW2",
@@ -19,32 +39,89 @@ RAW_FORMATS = {
 # ------------------------
 
 # Starts the raw processing for a single image
-def processRawImage(image, channelToSeparate="g"):
+# precision and bitDepth select the type and range of the processed image (see PRECISIONS and getPrecision())
+def processRawImage(image, channelToSeparate="g", precision="uint8", bitDepth=None, threads=None, tileRows=None):
+    return processRawImageChannels(image, [channelToSeparate], precision, bitDepth, threads, tileRows)[channelToSeparate]
+
+# Starts the raw processing for several color channels of a single image
+# The image is normalized once and debayered for every channel. Returns a dict with the debayered image per channel.
+# With threads > 1 the image is processed in bands of tileRows rows on a thread pool, see processBayerImageTiled()
+# threads and tileRows default to RAW_PROCESSING_THREADS and TILE_ROWS (read at call time, so they can be changed for the whole pipeline)
+def processRawImageChannels(image, channelsToSeparate=("r", "g", "b"), precision="uint8", bitDepth=None, threads=None, tileRows=None):
     # Check for valid image type
+    import rawpy
     if not isinstance(image, rawpy.RawPy):
         raise Exception(" ! Input can't be processed. The images need to be raw files imported with rawpy.")
     
     # Check for valid color channel
+    for channelToSeparate in channelsToSeparate:
+        if not re.compile(r'^[rRgGbB]$').match(channelToSeparate):
+            raise Exception(" ! '" + str(channelToSeparate) + "' is not a valid color channel. Use 'r', 'g' or 'b'.")
+    outputType, whiteValue = getPrecision(precision, bitDepth)
+    threads = RAW_PROCESSING_THREADS if threads is None else threads
+
+    if threads > 1:
+        with profileStage("normalize and debayer (tiled)"):
+            return processBayerImageTiled(image.raw_image_visible, image.raw_pattern, image.black_level_per_channel, image.camera_white_level_per_channel,
+                                          channelsToSeparate, outputType, whiteValue, tileRows, threads)
+    
+    with profileStage("normalize"):
+        imgNormalized = normalizeRawImage(image.raw_image_visible, image.raw_pattern, image.black_level_per_channel, image.camera_white_level_per_channel,
+                                          outputType, whiteValue=whiteValue)
+
+    imgsDebayered = {}
+    for channelToSeparate in channelsToSeparate:
+        with profileStage("debayer"):
+            imgsDebayered[channelToSeparate] = debayerSingleColor(imgNormalized, channelToSeparate)
+
+    return imgsDebayered
+
+# Opens a raw file and starts the raw processing for it
+def processRawFile(filePath, channelToSeparate="g", precision="uint8", bitDepth=None, threads=None, tileRows=None):
+    return processRawFileChannels(filePath, [channelToSeparate], precision, bitDepth, threads, tileRows)[channelToSeparate]
+
+# Opens a raw file once and starts the raw processing for several color channels (see processRawImageChannels())
+def processRawFileChannels(filePath, channelsToSeparate=("r", "g", "b"), precision="uint8", bitDepth=None, threads=None, tileRows=None):
+    import rawpy
+    with profileStage("decode"):
+        image = rawpy.imread(filePath)
+    with image:
+        return processRawImageChannels(image, channelsToSeparate, precision, bitDepth, threads, tileRows)
+
+# Starts the raw processing for a window of a single image (crop-first processing)
+# window = (y, x, height, width) in raw_image_visible coordinates, aligned to the BGGR-grid (see getRawAnalysisWindow())
+def processRawImageWindow(image, window, channelToSeparate="g", precision="uint8", bitDepth=None):
+    import rawpy
+    if not isinstance(image, rawpy.RawPy):
+        raise Exception(" ! Input can't be processed. The images need to be raw files imported with rawpy.")
     if not re.compile(r'^[rRgGbB]$').match(channelToSeparate):
         raise Exception(" ! '" + str(channelToSeparate) + "' is not a valid color channel. Use 'r', 'g' or 'b'.")
-    
-    imgNormalized = normalizeRawImage(image.raw_image_visible, image.raw_pattern, image.black_level_per_channel, image.camera_white_level_per_channel)
-    imgDebayered = debayerSingleColor(imgNormalized, channelToSeparate)
+    outputType, whiteValue = getPrecision(precision, bitDepth)
+
+    windowY, windowX, windowHeight, windowWidth = window
+    rawWindow = image.raw_image_visible[windowY:windowY+windowHeight, windowX:windowX+windowWidth]
+    with profileStage("normalize"):
+        imgNormalized = normalizeRawImage(rawWindow, BGGR_PATTERN, image.black_level_per_channel, image.camera_white_level_per_channel,
+                                          outputType, whiteValue=whiteValue)
+    with profileStage("debayer"):
+        imgDebayered = debayerSingleColor(imgNormalized, channelToSeparate)
 
     return imgDebayered
 
 # Starts the raw processing for two images
-def processRawImagePair(img1, img2, channelToSeparate="g"):
-    img1_out = processRawImage(img1, channelToSeparate)
-    img2_out = processRawImage(img2, channelToSeparate)
+def processRawImagePair(img1, img2, channelToSeparate="g", precision="uint8", bitDepth=None):
+    img1_out = processRawImage(img1, channelToSeparate, precision, bitDepth)
+    img2_out = processRawImage(img2, channelToSeparate, precision, bitDepth)
     return img1_out, img2_out
 
 # -----------------
 # - KEY FUNCTIONS -
 # -----------------
 
-# Normalize: Force BGGR, correct black- and whitelevel, Normalize (0-255)
-def normalizeRawImage(rawImage, bayerpattern, blacklevel, whitelevel, type=np.uint8):
+# Normalize: Force BGGR, correct black- and whitelevel, Normalize (0-whiteValue)
+# The raw image is never written to. An output buffer of the cropped BGGR shape can be given with out=.
+# type can be np.uint8 (truncated like before), np.uint16 (truncated, use a whiteValue above 255 to keep the dynamic range) or np.float32 (keeps the fractional part)
+def normalizeRawImage(rawImage, bayerpattern, blacklevel, whitelevel, type=np.uint8, out=None, whiteValue=255):
     # Convert image for BGGR bayerpattern
     if bayerpattern[0][0] == GREEN_1 or bayerpattern[0][0] == GREEN_2:
         if bayerpattern[0][1] == BLUE:
@@ -58,6 +135,33 @@ def normalizeRawImage(rawImage, bayerpattern, blacklevel, whitelevel, type=np.ui
         rawImage = rawImage[1:-1, 1:-1]
 
     print(" > Normalizing")
+    rawImage = np.asarray(rawImage)
+    if out is None:
+        out = np.empty(rawImage.shape, dtype=type)
+    elif out.shape != rawImage.shape:
+        raise Exception(" ! Output buffer of shape " + str(out.shape) + " doesn't match the image shape " + str(rawImage.shape) + ".")
+    return normalizeBggrImage(rawImage, blacklevel, whitelevel, out, whiteValue)
+
+# Corrects black- and whitelevel of a BGGR image (starting on a BGGR-cell) into the output buffer and normalizes it to 0-whiteValue
+def normalizeBggrImage(rawImage, blacklevel, whitelevel, out, whiteValue=255):
+    # Float outputs are computed in float32, integer outputs in float64 to stay identical to the previous results
+    workType = np.float32 if np.issubdtype(out.dtype, np.floating) else np.float64
+
+    # One pass per CFA-site with its own black- and whitelevel
+    for siteSlice, black, whiteRange in getBayerSiteLevels(blacklevel, whitelevel):
+        site = np.maximum(rawImage[siteSlice], black) # Prevent underflowing
+        site -= black
+        site = site.astype(workType)
+        site /= whiteRange
+        site *= whiteValue
+        out[siteSlice] = site
+
+    return out
+
+# Returns the black level and white range (whitelevel - blacklevel) for every site of a BGGR image as (slice, black, whiteRange).
+# Like in the original implementation the sites only get their own levels if the black levels differ: with equal black levels
+# a single site covering the whole image with the white range of red is returned, also if the white levels differ.
+def getBayerSiteLevels(blacklevel, whitelevel):
     blackR = blacklevel[RED]
     blackG = blacklevel[GREEN_1]
     blackB = blacklevel[BLUE]
@@ -65,66 +169,182 @@ def normalizeRawImage(rawImage, bayerpattern, blacklevel, whitelevel, type=np.ui
     whiteG = whitelevel[GREEN_1] - blackG
     whiteB = whitelevel[BLUE] - blackB
 
-    if blackR != blackG or blackB != blackR:
-        normalizedImage = []
-        for y, yVal in enumerate(rawImage):
-            normalizedImage.append([])
-            for x, xVal in enumerate(yVal):
-                if (y % 2 == 0 and x % 2 == 1) or (y % 2 == 1 and x % 2 == 0):
-                    # GREEN
-                    normalizedImage[y].append(((xVal-blackG)/whiteG * 255).astype(type))
-                elif (y % 2 == 0 and x % 2 == 0):
-                    # BLUE
-                    normalizedImage[y].append(((xVal-blackB)/whiteB * 255).astype(type))
-                else:
-                    # RED
-                    normalizedImage[y].append(((xVal-blackR)/whiteR * 255).astype(type))
-    else:
-        rawImage[rawImage <= blackR] = blackR # Prevent underflowing
-        normalizedImage = ((rawImage-blackR) / (whiteR) * 255).astype(type)
+    if blackR == blackG == blackB:
+        return [((slice(None), slice(None)), blackR, whiteR)]
 
-    return normalizedImage
+    return [
+        ((slice(0, None, 2), slice(0, None, 2)), blackB, whiteB), # BLUE
+        ((slice(0, None, 2), slice(1, None, 2)), blackG, whiteG), # GREEN
+        ((slice(1, None, 2), slice(0, None, 2)), blackG, whiteG), # GREEN
+        ((slice(1, None, 2), slice(1, None, 2)), blackR, whiteR)  # RED
+    ]
 
-# Does debayering for a single color of an rggb-image 
+# Does debayering for a single color of an rggb-image, the debayered image has the type of the input image
 def debayerSingleColor(bggrImg, debayerChannel):
-    bggrImg = np.array(bggrImg)
+    bggrImg = np.asarray(bggrImg)
     imgHeight, imgWidth = bggrImg.shape[:2]
 
     if re.search('g', debayerChannel, re.IGNORECASE):
         # Green debayer
         newWidth = math.ceil((imgHeight + imgWidth)/2)
         newHeight = newWidth-1
-        rotImage = np.zeros((newHeight, newWidth), dtype=np.uint8)
-        for y in range(imgHeight):
-                for x in range(imgWidth):
-                    # If its a green pixel put it at the rotated location (BGGR)
-                    if (y % 2 == 0 and x % 2 == 1) or (y % 2 == 1 and x % 2 == 0):
-                        newY = math.ceil((y + x)/2)-1
-                        newX = math.ceil((imgWidth - 1 - x + y)/2)
-                        rotImage[newY][newX] = bggrImg[y][x]
+        rotImage = np.zeros((newHeight, newWidth), dtype=bggrImg.dtype)
+
+        # Green pixels (BGGR) are rotated by 45° to newY = ceil((y+x)/2)-1, newX = ceil((imgWidth-1-x+y)/2).
+        # For the green pixel at (2i, 2j+1) this is (i+j, i-j+(imgWidth-1)//2), for (2i+1, 2j) it is (i+j, i-j+(imgWidth+1)//2).
+        # Both sites are therefore a strided view into the flat rotated image with strides (newWidth+1, newWidth-1).
+        _placeRotatedGreen(rotImage, bggrImg[0::2, 1::2], (imgWidth-1)//2)
+        _placeRotatedGreen(rotImage, bggrImg[1::2, 0::2], (imgWidth+1)//2)
         return rotImage
     else:
         # Red / blue debayer
         newHeight = math.ceil(imgHeight/2 + 1)
         newWidth = math.ceil(imgWidth/2 + 1)
-        debayeredImage = np.zeros((newHeight, newWidth), dtype=np.uint8)
+        debayeredImage = np.zeros((newHeight, newWidth), dtype=bggrImg.dtype)
 
         isRedDebayer = re.search('r', debayerChannel, re.IGNORECASE)
         isBlueDebayer = re.search('b', debayerChannel, re.IGNORECASE)
 
-        for y in range(imgHeight):
-                for x in range(imgWidth):
-                    # If its a red or blue pixel store it in the corresponding new image (BGGR)
-                    if (isBlueDebayer and (y % 2 == 0 and x % 2 == 0)) or (isRedDebayer and (y % 2 == 1 and x % 2 == 1)):
-                        newY = math.ceil((y)/2)
-                        newX = math.ceil((x)/2)
-                        debayeredImage[newY][newX] = bggrImg[y][x]
+        # Red and blue pixels are stored at (ceil(y/2), ceil(x/2)) of the new image (BGGR)
+        if isRedDebayer:
+            redSites = bggrImg[1::2, 1::2]
+            debayeredImage[1:1+redSites.shape[0], 1:1+redSites.shape[1]] = redSites
+        if isBlueDebayer:
+            blueSites = bggrImg[0::2, 0::2]
+            debayeredImage[:blueSites.shape[0], :blueSites.shape[1]] = blueSites
                         
         return debayeredImage
 
+# Writes one green sublattice into the rotated image: site (i, j) lands at (i+j, i-j+offset)
+# firstSite shifts the sites by whole rows of the sublattice, e.g. for a band of the image starting at BGGR row 2*firstSite
+def _placeRotatedGreen(rotImage, greenSites, offset, firstSite=0):
+    sitesHeight, sitesWidth = greenSites.shape[:2]
+    if sitesHeight == 0 or sitesWidth == 0:
+        return
+    rotWidth = rotImage.shape[1]
+
+    # The last written element has to lie inside the rotated image
+    lastY = firstSite + sitesHeight - 1 + sitesWidth - 1
+    lastX = firstSite + sitesHeight - 1 + offset
+    if lastY >= rotImage.shape[0] or lastX >= rotWidth or firstSite + offset - (sitesWidth - 1) < 0:
+        raise IndexError(" ! Image of shape " + str(rotImage.shape) + " is too small for the rotated green channel.")
+
+    flatImage = rotImage.reshape(-1)
+    itemSize = flatImage.itemsize
+    rotatedView = np.lib.stride_tricks.as_strided(flatImage[firstSite*(rotWidth+1) + offset:], shape=(sitesHeight, sitesWidth),
+                                                  strides=((rotWidth+1)*itemSize, (rotWidth-1)*itemSize))
+    rotatedView[...] = greenSites
+
+
+# ----------------------------------
+# - TILED (MULTI-THREADED) PROCESSING -
+# ----------------------------------
+
+# Normalizes and debayers a raw image in bands of tileRows BGGR rows on a thread pool (numpy releases the GIL), the result is identical to
+# normalizeRawImage() followed by debayerSingleColor() for every channel. Every band is written straight into one preallocated output per channel.
+# The bands start on a BGGR-cell and don't need to overlap: every pixel of a band has its own position in the output, only the
+# rows of the 45° rotated green channel that belong to two neighbouring bands are written from both (at different pixels).
+def processBayerImageTiled(rawImage, bayerpattern, blacklevel, whitelevel, channelsToSeparate=("g",), type=np.uint8, whiteValue=255, tileRows=None, threads=4):
+    offsetY, offsetX = getBggrOffset(bayerpattern)
+    rawImage = np.asarray(rawImage)
+    bggrImage = rawImage[offsetY:rawImage.shape[0]-offsetY, offsetX:rawImage.shape[1]-offsetX]
+    imgHeight, imgWidth = bggrImage.shape[:2]
+    tileRows = TILE_ROWS if tileRows is None else tileRows
+    tileRows = max(2, tileRows + tileRows % 2)
+
+    print(" > Normalizing and debayering in bands of " + str(tileRows) + " rows (" + str(threads) + " threads)")
+    outputs = {}
+    for channelToSeparate in channelsToSeparate:
+        if channelToSeparate not in outputs:
+            outputs[channelToSeparate] = np.zeros(getDebayeredShape(bggrImage.shape, BGGR_PATTERN, channelToSeparate), dtype=type)
+
+    def processBand(bandStart):
+        bandImage = bggrImage[bandStart:bandStart+tileRows]
+        bandNormalized = normalizeBggrImage(bandImage, blacklevel, whitelevel, np.empty(bandImage.shape, dtype=type), whiteValue)
+        for channelToSeparate, output in outputs.items():
+            debayerBand(bandNormalized, channelToSeparate, output, bandStart, imgWidth)
+
+    with ThreadPoolExecutor(max_workers=threads) as threadPool:
+        # Raises the first error of a band
+        for _ in threadPool.map(processBand, range(0, imgHeight, tileRows)):
+            pass
+    return outputs
+
+# Writes a band of a normalized BGGR image (starting at BGGR row bandStart) into the debayered image of the whole image (see debayerSingleColor())
+def debayerBand(bandImage, debayerChannel, debayeredImage, bandStart, imgWidth):
+    firstSite = bandStart // 2
+    if re.search('g', debayerChannel, re.IGNORECASE):
+        _placeRotatedGreen(debayeredImage, bandImage[0::2, 1::2], (imgWidth-1)//2, firstSite)
+        _placeRotatedGreen(debayeredImage, bandImage[1::2, 0::2], (imgWidth+1)//2, firstSite)
+        return
+    if re.search('r', debayerChannel, re.IGNORECASE):
+        redSites = bandImage[1::2, 1::2]
+        debayeredImage[1+firstSite:1+firstSite+redSites.shape[0], 1:1+redSites.shape[1]] = redSites
+    if re.search('b', debayerChannel, re.IGNORECASE):
+        blueSites = bandImage[0::2, 0::2]
+        debayeredImage[firstSite:firstSite+blueSites.shape[0], :blueSites.shape[1]] = blueSites
+
+# -----------------------------
+# - CROP-FIRST HELPER FUNCTIONS -
+# -----------------------------
+
+# Returns the (y, x) offset of the first BGGR-cell in a raw image (same conversion as in normalizeRawImage())
+def getBggrOffset(bayerpattern):
+    if bayerpattern[0][0] == GREEN_1 or bayerpattern[0][0] == GREEN_2:
+        return (0, 1) if bayerpattern[0][1] == BLUE else (1, 0)
+    elif bayerpattern[0][0] == RED:
+        return (1, 1)
+    return (0, 0)
+
+# Returns the shape the BGGR image and the debayered image of the full raw image would have
+def getDebayeredShape(rawShape, bayerpattern, channelToSeparate="g"):
+    offsetY, offsetX = getBggrOffset(bayerpattern)
+    bggrHeight, bggrWidth = rawShape[0] - 2*offsetY, rawShape[1] - 2*offsetX
+    if re.search('g', channelToSeparate, re.IGNORECASE):
+        newWidth = math.ceil((bggrHeight + bggrWidth)/2)
+        return (newWidth-1, newWidth)
+    return (math.ceil(bggrHeight/2 + 1), math.ceil(bggrWidth/2 + 1))
+
+# Cheap preview for finding the analyzed area: mean of the two green pixels of every BGGR-cell (half resolution, not normalized)
+def createGreenPreview(rawImage, bayerpattern):
+    offsetY, offsetX = getBggrOffset(bayerpattern)
+    bggrImage = rawImage[offsetY:, offsetX:]
+    cellsY, cellsX = bggrImage.shape[0] // 2, bggrImage.shape[1] // 2
+    preview = bggrImage[0:2*cellsY:2, 1:2*cellsX:2].astype(np.float32)
+    preview += bggrImage[1:2*cellsY:2, 0:2*cellsX:2]
+    preview *= 0.5
+    return preview
+
+# Returns the raw window (y, x, height, width) around the given center in raw coordinates.
+# The window starts on a BGGR-cell, has an even size and lies inside the image.
+def getRawAnalysisWindow(rawShape, bayerpattern, center, windowSize):
+    offsets = getBggrOffset(bayerpattern)
+    window = []
+    for centerPos, offset, rawSize in zip(center, offsets, rawShape):
+        usableSize = (rawSize - 2*offset) // 2 * 2
+        size = min(int(math.ceil(windowSize/2)) * 2, usableSize)
+        start = int(centerPos - size/2)
+        start = max(min(start, offset + usableSize - size), offset)
+        start -= (start - offset) % 2
+        window.append((start, size))
+    (windowY, windowHeight), (windowX, windowWidth) = window
+    return windowY, windowX, windowHeight, windowWidth
+
+# Returns the type and the normalized white value (2**bitDepth - 1) of a precision (see PRECISIONS)
+# bitDepth None uses the default bit depth of the precision, integer types can't hold more bits than they have
+def getPrecision(precision="uint8", bitDepth=None):
+    if precision not in PRECISIONS:
+        raise Exception(" ! '" + str(precision) + "' is not a valid precision. Use one of " + str(list(PRECISIONS)) + ".")
+    outputType, defaultBitDepth = PRECISIONS[precision]
+    bitDepth = defaultBitDepth if bitDepth is None else int(bitDepth)
+    maxBitDepth = np.iinfo(outputType).bits if np.issubdtype(outputType, np.integer) else 24
+    if not 1 <= bitDepth <= maxBitDepth:
+        raise Exception(" ! A bit depth of " + str(bitDepth) + " isn't possible with precision '" + precision + "'. Use 1 to " + str(maxBitDepth) + ".")
+    return outputType, 2**bitDepth - 1
 
 # Support function
 def readRawImage(path, name, fileExtention):
+    import rawpy
     return rawpy.imread(path + name + "." + fileExtention)
 
 
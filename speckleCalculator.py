@@ -1,11 +1,25 @@
 import numpy as np
-import rawpy
-from scipy import ndimage
-import cv2
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Button, Slider
-from rawProcessor import processRawImagePair, processRawImage, RAW_FORMATS
+import os
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from speckleCore import (findBrightestArea, sumAllAreas, cropImage, getImagePerforationMask, findPerforationThreshold, flattenImage, calculateSpeckleContrast,
+                         highPassFilter2D, highPassFilterFlat, getLowPassType, gaussianBlur, getCropSize, debugShowImg,
+                         FILTER_MODES, FILTER_BACKENDS, PERFORATION_THRESHOLD_METHODS)
+from rawProcessor import processRawImagePair, processRawImage, processRawFile, processRawFileChannels, processRawImageWindow, getBggrOffset, getDebayeredShape, createGreenPreview, getRawAnalysisWindow, getPrecision, RAW_FORMATS
 import dataManager
+import rawCache
+import imageLoader
+from stageProfiler import StageProfiler, activateProfiler, profileStage
+
+# Number of decoded reference images and of processed reference crops that are kept in memory while a batch reuses references
+REFERENCE_CACHE_SIZE = 4
+REFERENCE_CROP_CACHE_SIZE = 32
+# Margin (in raw pixels) around the analyzed area in crop-first processing, leaves room to refine the brightest area
+CROP_FIRST_MARGIN = 64
+
+# The numeric core (crop, mask, filter, contrast) is in speckleCore.py and imported from there. rawpy, OpenCV, scipy and
+# matplotlib are only imported when RAW files or images are loaded, a filter runs or the threshold-slider opens.
 
 '''
 ---- Vorverarbeitung der Bilder ----
@@ -25,134 +39,473 @@ import dataManager
 # ------------------------
 
 # Main function to start the speckle calculation
-def analyzeImage(path, refName, imgName, datatype, useRefImg=True, debayerChannel="g", metadata={}, saveFileName=None):
-    print("__________________")
-    print("Loading and processing image '"+ imgName + "' " + "[" + datatype + "]" + "...")
-    rawTypes = list(RAW_FORMATS.values())
-
-    refPath = path + refName + "." + datatype
-    imgPath = path + imgName + "." + datatype
-    metadata["color"] = debayerChannel 
-
-    # Preprocess images based on datatype
-    # RAW: Normalisation, custom single-channel debayering
-    # Other: Get a single color channel from RGB image
-    if datatype in rawTypes: 
-        # RAW processing 
-        if useRefImg:
-            with rawpy.imread(imgPath) as rawImg, rawpy.imread(refPath) as rawRef:
-                img, refImg = processRawImagePair(rawImg, rawRef, debayerChannel)
+# Returns the results of calculateProjectionSpeckle(). If perforationThreshold is given the perforation mask is generated without user interaction.
+# Processed RAW frames are cached on disk (see rawCache.py) unless useCache is False.
+# With reuseReference the reference image and its products for a crop are kept in memory (LRU) for following measurements with the same reference.
+# Results are saved with dataManager.ResultSink, resultSinks can hold open sinks by file name (see saveResults()).
+# With profile the wall time, CPU time and peak memory of every stage are added to the results as "stages" (see stageProfiler.py).
+# Saving isn't profiled, so the saved row holds the same stages as the returned results.
+# With cropFirst only a window around the brightest area of RAW images is processed (see loadRawWindowsCropFirst()), the disk cache isn't used then.
+# debayerChannel can be a list of channels (e.g. ["r", "g", "b"]), see analyzeImageChannels()
+# precision ("uint8", "uint16" or "float32") and bitDepth set the type and range of the images from decoding to filtering (see rawProcessor.getPrecision()).
+# perforationThreshold stays in the 0-255 range for every precision.
+# rawThreads and tileRows set the threads and band height of the RAW normalization and debayering (see rawProcessor.processRawImageChannels()),
+# None uses rawProcessor.RAW_PROCESSING_THREADS and TILE_ROWS. In a parallel batch every worker process uses rawThreads.
+# coarseStep > 1 searches the brightest area coarse-to-fine (faster on large images, may miss the exact maximum, see speckleCore.findBrightestArea())
+def analyzeImage(path, refName, imgName, datatype, useRefImg=True, debayerChannel="g", metadata={}, saveFileName=None, filterMode="flat", filterBackend="scipy", perforationThreshold=None, useCache=True, reuseReference=False, resultSinks=None, profile=False, cropFirst=False, precision="uint8", bitDepth=None, rawThreads=None, tileRows=None,
+                 coarseStep=1):
+    if isinstance(debayerChannel, (list, tuple)):
+        return analyzeImageChannels(path, refName, imgName, datatype, useRefImg, debayerChannel, metadata, saveFileName, filterMode, filterBackend, perforationThreshold, useCache, resultSinks, profile, precision, bitDepth, rawThreads, tileRows,
+                                    coarseStep)
+    _, whiteValue = getPrecision(precision, bitDepth)
+
+    profiler = StageProfiler() if profile else None
+    with activateProfiler(profiler):
+        print("__________________")
+        print("Loading and processing image '"+ imgName + "' " + "[" + datatype + "]" + "...")
+
+        refPath = path + refName + "." + datatype
+        imgPath = path + imgName + "." + datatype
+        metadata["color"] = debayerChannel 
+
+        # Crop-first: only the analyzed window of the RAW images is normalized and debayered
+        if cropFirst and datatype in RAW_FORMATS.values():
+            img, refImg, cropSize = loadRawWindowsCropFirst(imgPath, refPath, debayerChannel, useRefImg, precision=precision, bitDepth=bitDepth)
+            results = calculateProjectionSpeckle(refImg, img, useRefImg, filterMode, filterBackend, perforationThreshold, cropSize=cropSize, whiteValue=whiteValue, coarseStep=coarseStep)
         else:
-            with rawpy.imread(imgPath) as rawImg:
-                img = processRawImage(rawImg, debayerChannel)
-    else:
-        # Standard processing (JPG, PNG)
-        # Process reference image
-        if useRefImg:
-            refImg = cv2.imread(refPath)
-            if refImg is not None:
-                r, g, b = cv2.split(refImg)
-                refImg = g if debayerChannel=="g" else r if debayerChannel=="r" else b
-        
-        # Process speckle image
-        img = cv2.imread(imgPath)
-        r, g, b = cv2.split(img)
-        img = g if debayerChannel=="g" else r if debayerChannel=="r" else b
-
-    # Call speckle calculation
-    if useRefImg:
-        results = calculateProjectionSpeckle(refImg, img)
-    else:
-        results = calculateProjectionSpeckle(None, img, useRefImg)
+            # Preprocess images based on datatype
+            with profileStage("load image"):
+                img = loadImageChannel(imgPath, datatype, debayerChannel, useCache, precision, bitDepth, rawThreads, tileRows)
+            if img is None:
+                raise Exception(" ! Image '" + imgPath + "' couldn't be loaded.")
+
+            # Call speckle calculation
+            if useRefImg and reuseReference:
+                refStamp = getFileStamp(refPath)
+                def referenceProvider(cropFilter):
+                    return getCachedReferenceSpeckle(refPath, refStamp, datatype, debayerChannel, useCache, tuple(cropFilter), perforationThreshold, filterMode, filterBackend, precision, bitDepth,
+                                                     rawThreads, tileRows)
+                results = calculateProjectionSpeckle(None, img, filterMode=filterMode, filterBackend=filterBackend, referenceProvider=referenceProvider, coarseStep=coarseStep)
+            elif useRefImg:
+                with profileStage("load reference"):
+                    refImg = loadImageChannel(refPath, datatype, debayerChannel, useCache, precision, bitDepth, rawThreads, tileRows)
+                results = calculateProjectionSpeckle(refImg, img, filterMode=filterMode, filterBackend=filterBackend, perforationThreshold=perforationThreshold, whiteValue=whiteValue,
+                                                     coarseStep=coarseStep)
+            else:
+                results = calculateProjectionSpeckle(None, img, useRefImg, filterMode, filterBackend, whiteValue=whiteValue, coarseStep=coarseStep)
+
+    # Attach the recorded stages to the results
+    if profiler is not None:
+        results["stages"] = profiler.records
 
-    # Generate csv-data and save to csv if a save-name is given
+    # Save results if a save-name is given
     if type(saveFileName) == type("STRING"):
         if(saveFileName != ""):
-            imgData = {"name": imgName, "datatype": datatype, "path": imgPath}
-            dataToSave = [dataManager.getCurrentTime(), imgData, results, metadata]
-            dataManager.appendToCSV([dataToSave], saveFileName)
+            saveResults(saveFileName, imgName, datatype, imgPath, results, metadata, resultSinks)
+
+    return results
+
+# Analyzes several color channels of the same images. Every image is decoded and normalized once, only the debayering is done per channel.
+# The brightest area and the perforation mask are shared by all channels with the same debayered geometry: red and blue share them,
+# the 45° rotated green channel has its own (for JPG, PNG, ... all channels share them). The area is located in green if it is requested.
+# Returns a dict with the results of calculateProjectionSpeckle() per channel, every channel is saved as its own row (metadata "color").
+# The reference is processed once per call, reuseReference and cropFirst of analyzeImage() don't apply to multiple channels.
+def analyzeImageChannels(path, refName, imgName, datatype, useRefImg=True, debayerChannels=("r", "g", "b"), metadata={}, saveFileName=None, filterMode="flat", filterBackend="scipy", perforationThreshold=None, useCache=True, resultSinks=None, profile=False, precision="uint8", bitDepth=None,
+                         rawThreads=None, tileRows=None, coarseStep=1):
+    _, whiteValue = getPrecision(precision, bitDepth)
+    profiler = StageProfiler() if profile else None
+    with activateProfiler(profiler):
+        print("__________________")
+        print("Loading and processing image '"+ imgName + "' " + "[" + datatype + "] (" + ", ".join(debayerChannels) + ")...")
+
+        refPath = path + refName + "." + datatype
+        imgPath = path + imgName + "." + datatype
+
+        with profileStage("load image"):
+            images = loadImageChannels(imgPath, datatype, debayerChannels, useCache, precision, bitDepth, rawThreads, tileRows)
+        if images is None:
+            raise Exception(" ! Image '" + imgPath + "' couldn't be loaded.")
+        refImages = None
+        if useRefImg:
+            with profileStage("load reference"):
+                refImages = loadImageChannels(refPath, datatype, debayerChannels, useCache, precision, bitDepth, rawThreads, tileRows)
+            if refImages is None:
+                raise Exception(" ! Image '" + refPath + "' couldn't be loaded.")
+
+        # Group the channels by geometry, the green channel (if requested) locates the area of its group
+        channelGroups = {}
+        for debayerChannel in sorted(debayerChannels, key=lambda channel: channel != "g"):
+            channelGroups.setdefault(np.shape(images[debayerChannel]), []).append(debayerChannel)
+
+        channelResults = {}
+        for channelGroup in channelGroups.values():
+            locatingImage = images[channelGroup[0]]
+            cropSize = getCropSize(np.shape(locatingImage)[1])
+            print(" > Finding brightest area (" + ", ".join(channelGroup) + ")")
+            with profileStage("find brightest area"):
+                cropFilter = findBrightestArea(locatingImage, (cropSize, cropSize), coarseStep=coarseStep)
+            perfMask = None
+            if useRefImg:
+                print(" > Generating perforation mask (" + ", ".join(channelGroup) + ")")
+                with profileStage("perforation mask"):
+                    perfMask = findPerforations(cropImage(refImages[channelGroup[0]], cropFilter), perforationThreshold, whiteValue)
+
+            for debayerChannel in channelGroup:
+                print("\nChannel '" + debayerChannel + "':")
+                refImg = refImages[debayerChannel] if useRefImg else None
+                channelResults[debayerChannel] = calculateProjectionSpeckle(refImg, images[debayerChannel], useRefImg, filterMode, filterBackend,
+                                                                            perforationThreshold, cropSize=cropSize, cropFilter=cropFilter, perfMask=perfMask, whiteValue=whiteValue)
+
+    # Attach the recorded stages (shared by all channels) to the results
+    if profiler is not None:
+        for results in channelResults.values():
+            results["stages"] = profiler.records
+
+    # Save results if a save-name is given, in the requested channel order
+    if type(saveFileName) == type("STRING") and saveFileName != "":
+        for debayerChannel in debayerChannels:
+            saveResults(saveFileName, imgName, datatype, imgPath, channelResults[debayerChannel], dict(metadata, color=debayerChannel), resultSinks)
+
+    return {debayerChannel: channelResults[debayerChannel] for debayerChannel in debayerChannels}
 
 # Same as analyzeImage() without the need to handel the refImage in any way 
 def analyzeImageNoRef(path, imgName, datatype, debayerChannel="g", metadata={}, saveFileName=None):
-    analyzeImage(path, "", imgName, datatype, useRefImg=False, debayerChannel=debayerChannel, metadata=metadata, saveFileName=saveFileName)
+    return analyzeImage(path, "", imgName, datatype, useRefImg=False, debayerChannel=debayerChannel, metadata=metadata, saveFileName=saveFileName)
 
 # Simplified function to call if a single image should be processed
 def analyzeSingleMeasurement(measurement):
-    analyzeMeasurementBatch([measurement])
+    return analyzeMeasurementBatch([measurement])[0]
 
 # Simplified function to call if multiple images should be processed after one another
-def analyzeMeasurementBatch(measuerementBatch):
-    for measurement in measuerementBatch:
-        path = measurement["path"]
-        refName = measurement["refName"] if "refName" in measurement else ""
-        imgName = measurement["imgName"]
-        datatype = measurement["datatype"]
-        useRefImg = measurement["useRefImg"] if "useRefImg" in measurement else "True"
-        debayerChannel = measurement["debayerChannel"] if "debayerChannel" in measurement else "g"
-        metadata = measurement["metadata"] if "metadata" in measurement else {}
-        saveFileName = measurement["saveFileName"] if "saveFileName" in measurement else None
-        
-        analyzeImage(path, refName, imgName, datatype, useRefImg, debayerChannel, metadata, saveFileName)
+# Returns the results of all measurements in the order of the batch. Measurements sharing a reference are processed together and reuse it.
+# With workers > 1 the measurements are analyzed in parallel processes. A failing measurement doesn't abort the batch, 
+# its exception is returned in place of the results. The perforation mask can't be chosen interactively in this mode,
+# so every measurement needs a "perforationThreshold" or a default has to be given with perforationThreshold.
+# On Windows the calling script has to be guarded with if __name__ == "__main__" to use workers > 1.
+# resultCallback is called with the batch index and the results (or exception) of every finished measurement, after its results are saved.
+# With stopOnError False a failing measurement doesn't abort a batch with workers=1 either, its exception is returned in place of the results.
+def analyzeMeasurementBatch(measuerementBatch, workers=1, perforationThreshold=None, resultCallback=None, stopOnError=True):
+    if workers > 1:
+        return analyzeMeasurementBatchParallel(measuerementBatch, workers, perforationThreshold, resultCallback)
+
+    # Measurements with the same reference are analyzed after one another to reuse the reference
+    batchResults = [None] * len(measuerementBatch)
+    resultSinks = {}
+    try:
+        for index in getReferenceGroupedOrder(measuerementBatch):
+            arguments = getMeasurementArguments(measuerementBatch[index], perforationThreshold)
+            try:
+                batchResults[index] = analyzeImage(**arguments, reuseReference=True, resultSinks=resultSinks)
+            except Exception as error:
+                if stopOnError:
+                    raise
+                print(" ! Measurement '" + str(arguments["imgName"]) + "' failed: " + str(error))
+                batchResults[index] = error
+            if resultCallback is not None:
+                flushResultSinks(resultSinks)
+                resultCallback(index, batchResults[index])
+    finally:
+        clearReferenceCache()
+        closeResultSinks(resultSinks)
+    return batchResults
+
+# Analyzes the measurements in a process pool and returns their results in the order of the batch
+# The files of upcoming measurements are read ahead in a thread pool, so file I/O overlaps with the computation in the workers
+# If a worker process dies (e.g. rawpy/LibRaw crashing on a corrupt file) the pool is replaced and the measurements that were running in it
+# are analyzed again one at a time (see analyzeMeasurementInNewProcess()), so only the crashing measurement fails
+def analyzeMeasurementBatchParallel(measuerementBatch, workers=os.cpu_count(), perforationThreshold=None, resultCallback=None):
+    batchSize = len(measuerementBatch)
+    batchResults = [None] * batchSize
+    batchOrder = getReferenceGroupedOrder(measuerementBatch)
+    maxInFlight = 2 * workers
+    prefetches = {}
+    runningIndices = {}
+    nextPrefetch = nextSubmit = 0
+
+    # Results are saved by this process only, the workers don't write to the result tables
+    resultSinks = {}
+    workerBatch = [dict(measurement, saveFileName=None) for measurement in measuerementBatch]
+
+    def recordResult(index, results):
+        batchResults[index] = results
+        if not isinstance(results, Exception):
+            saveMeasurementResults(measuerementBatch[index], results, resultSinks)
+        if resultCallback is not None:
+            flushResultSinks(resultSinks)
+            resultCallback(index, results)
+
+    processPool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as filePool:
+            while nextSubmit < batchSize or runningIndices:
+                # Read ahead the files of the next measurements
+                while nextPrefetch < batchSize and nextPrefetch < nextSubmit + maxInFlight:
+                    prefetches[nextPrefetch] = filePool.submit(prefetchMeasurementFiles, measuerementBatch[batchOrder[nextPrefetch]])
+                    nextPrefetch += 1
+
+                # Keep the workers busy
+                poolBroken = False
+                while nextSubmit < batchSize and len(runningIndices) < maxInFlight:
+                    prefetches[nextSubmit].result()
+                    index = batchOrder[nextSubmit]
+                    try:
+                        future = processPool.submit(analyzeMeasurementIsolated, workerBatch[index], perforationThreshold)
+                    except BrokenProcessPool:
+                        poolBroken = True
+                        break
+                    del prefetches[nextSubmit]
+                    runningIndices[future] = index
+                    nextSubmit += 1
+
+                finished, _ = wait(list(runningIndices), return_when=FIRST_COMPLETED)
+                # After a crash all measurements in the pool fail, wait for them to be sure which ones finished before
+                if poolBroken or any(isinstance(future.exception(), BrokenProcessPool) for future in finished):
+                    poolBroken = True
+                    finished, _ = wait(list(runningIndices))
+
+                crashedIndices = []
+                for future in finished:
+                    index = runningIndices.pop(future)
+                    try:
+                        results = future.result()
+                    except BrokenProcessPool:
+                        crashedIndices.append(index)
+                        continue
+                    except Exception as error:
+                        results = error
+                    recordResult(index, results)
+
+                if poolBroken:
+                    print(" ! A worker process crashed, analyzing the " + str(len(crashedIndices)) + " measurements that were running one at a time")
+                    processPool.shutdown(wait=False, cancel_futures=True)
+                    processPool = ProcessPoolExecutor(max_workers=workers)
+                    for index in crashedIndices:
+                        recordResult(index, analyzeMeasurementInNewProcess(workerBatch[index], perforationThreshold))
+    finally:
+        processPool.shutdown(cancel_futures=True)
+        closeResultSinks(resultSinks)
+
+    for index, result in enumerate(batchResults):
+        if isinstance(result, Exception):
+            print(" ! Measurement '" + str(measuerementBatch[index].get("imgName")) + "' failed: " + str(result))
+    return batchResults
+
+# Worker of analyzeMeasurementBatchParallel(): returns the results or the raised exception of a single measurement
+def analyzeMeasurementIsolated(measurement, perforationThreshold=None):
+    try:
+        arguments = getMeasurementArguments(measurement, perforationThreshold)
+        if arguments["useRefImg"] and arguments["perforationThreshold"] is None:
+            raise Exception(" ! No perforationThreshold given. The perforation mask can't be chosen interactively in a parallel batch.")
+        return analyzeImage(**arguments, reuseReference=True)
+    except Exception as error:
+        return error
+
+# Analyzes a single measurement in a new worker process, used after a worker crashed to find the measurement that caused it
+# Returns the results or an exception, also if this worker crashes too
+def analyzeMeasurementInNewProcess(measurement, perforationThreshold=None):
+    with ProcessPoolExecutor(max_workers=1) as isolatedPool:
+        try:
+            return isolatedPool.submit(analyzeMeasurementIsolated, measurement, perforationThreshold).result()
+        except BrokenProcessPool as error:
+            return Exception(" ! The worker process crashed while analyzing '" + str(measurement.get("imgName")) + "': " + str(error))
+
+# Reads the files of a measurement once, so they are in the file cache when a worker opens them
+def prefetchMeasurementFiles(measurement, chunkSize=2**22):
+    names = [measurement["imgName"]]
+    if measurement.get("useRefImg", True):
+        names.append(measurement.get("refName", ""))
+
+    for name in names:
+        try:
+            with open(measurement["path"] + name + "." + measurement["datatype"], "rb") as file:
+                while file.read(chunkSize):
+                    pass
+        except OSError:
+            pass # The worker reports missing files
+
+# Saves the results of an image to the result table saveFileName (csv with scalars, pixel arrays as .npz next to it)
+# A saveFileName ending with ".db" saves to an indexed SQLite store instead (see dataManager.ResultStore)
+# If a dict of open sinks is given the sink is kept open (buffered) and has to be closed with closeResultSinks()
+def saveResults(saveFileName, imgName, datatype, imgPath, results, metadata={}, resultSinks=None):
+    imgData = {"name": imgName, "datatype": datatype, "path": imgPath}
+    if resultSinks is None:
+        with dataManager.openResultSink(saveFileName) as resultSink:
+            resultSink.write(results, imgData, metadata)
+    else:
+        if saveFileName not in resultSinks:
+            resultSinks[saveFileName] = dataManager.openResultSink(saveFileName)
+        resultSinks[saveFileName].write(results, imgData, metadata)
+
+# Saves the results of a measurement dict if it has a saveFileName
+def saveMeasurementResults(measurement, results, resultSinks=None):
+    arguments = getMeasurementArguments(measurement)
+    saveFileName, imgName, datatype = arguments["saveFileName"], arguments["imgName"], arguments["datatype"]
+    if type(saveFileName) == type("STRING") and saveFileName != "":
+        imgPath = arguments["path"] + imgName + "." + datatype
+        debayerChannel = arguments["debayerChannel"]
+        if isinstance(debayerChannel, (list, tuple)):
+            for channel in debayerChannel:
+                saveResults(saveFileName, imgName, datatype, imgPath, results[channel], dict(arguments["metadata"], color=channel), resultSinks)
+        else:
+            saveResults(saveFileName, imgName, datatype, imgPath, results, dict(arguments["metadata"], color=debayerChannel), resultSinks)
+
+# Writes the buffered rows of all given result sinks, e.g. before the progress of a batch is recorded
+def flushResultSinks(resultSinks):
+    for resultSink in resultSinks.values():
+        resultSink.flush()
+
+# Writes and closes all given result sinks
+def closeResultSinks(resultSinks):
+    for resultSink in resultSinks.values():
+        resultSink.close()
+    resultSinks.clear()
+
+# Returns the indices of the batch ordered so that measurements with the same reference follow each other (stable)
+def getReferenceGroupedOrder(measuerementBatch):
+    def referenceKey(index):
+        measurement = measuerementBatch[index]
+        if not measurement.get("useRefImg", True):
+            return ("", "", "", "")
+        return (measurement["path"], measurement.get("refName", ""), measurement["datatype"], str(measurement.get("debayerChannel", "g")))
+    return sorted(range(len(measuerementBatch)), key=referenceKey)
+
+# Returns the keyword arguments of analyzeImage() for a measurement dict (see examples.py)
+def getMeasurementArguments(measurement, perforationThreshold=None):
+    path = measurement["path"]
+    refName = measurement["refName"] if "refName" in measurement else ""
+    imgName = measurement["imgName"]
+    datatype = measurement["datatype"]
+    useRefImg = measurement["useRefImg"] if "useRefImg" in measurement else True
+    debayerChannel = measurement["debayerChannel"] if "debayerChannel" in measurement else "g"
+    metadata = measurement["metadata"] if "metadata" in measurement else {}
+    saveFileName = measurement["saveFileName"] if "saveFileName" in measurement else None
+    filterMode = measurement["filterMode"] if "filterMode" in measurement else "flat"
+    filterBackend = measurement["filterBackend"] if "filterBackend" in measurement else "scipy"
+    perforationThreshold = measurement["perforationThreshold"] if "perforationThreshold" in measurement else perforationThreshold
+    useCache = measurement["useCache"] if "useCache" in measurement else True
+    profile = measurement["profile"] if "profile" in measurement else False
+    cropFirst = measurement["cropFirst"] if "cropFirst" in measurement else False
+    precision = measurement["precision"] if "precision" in measurement else "uint8"
+    bitDepth = measurement["bitDepth"] if "bitDepth" in measurement else None
+    rawThreads = measurement["rawThreads"] if "rawThreads" in measurement else None
+    tileRows = measurement["tileRows"] if "tileRows" in measurement else None
+    coarseStep = measurement["coarseStep"] if "coarseStep" in measurement else 1
+
+    return {"path": path, "refName": refName, "imgName": imgName, "datatype": datatype, "useRefImg": useRefImg, "debayerChannel": debayerChannel, 
+            "metadata": metadata, "saveFileName": saveFileName, "filterMode": filterMode, "filterBackend": filterBackend, 
+            "perforationThreshold": perforationThreshold, "useCache": useCache, "profile": profile, "cropFirst": cropFirst,
+            "precision": precision, "bitDepth": bitDepth, "rawThreads": rawThreads, "tileRows": tileRows, "coarseStep": coarseStep}
+
+# Loads a single color channel of an image
+# RAW: Normalisation, custom single-channel debayering (cached on disk with useCache)
+# Other: Get a single color channel from an image (JPG, PNG, TIFF) or a precomputed array (.npy, memory mapped), see imageLoader.py
+# None if the image can't be read. The image has the type and range of the given precision (see rawProcessor.getPrecision()).
+def loadImageChannel(filePath, datatype, debayerChannel="g", useCache=True, precision="uint8", bitDepth=None, rawThreads=None, tileRows=None):
+    images = loadImageChannels(filePath, datatype, [debayerChannel], useCache, precision, bitDepth, rawThreads, tileRows)
+    return None if images is None else images[debayerChannel]
+
+# Same as loadImageChannel() for several channels with a single decode (and normalisation) of the file
+# Returns a dict with the image per channel, None if the image can't be read. rawThreads and tileRows only apply to RAW files (see analyzeImage()).
+def loadImageChannels(filePath, datatype, debayerChannels=("r", "g", "b"), useCache=True, precision="uint8", bitDepth=None, rawThreads=None, tileRows=None):
+    if datatype in RAW_FORMATS.values():
+        if useCache:
+            return rawCache.loadProcessedRawImageChannels(filePath, debayerChannels, precision=precision, bitDepth=bitDepth, threads=rawThreads, tileRows=tileRows)
+        return processRawFileChannels(filePath, debayerChannels, precision, bitDepth, rawThreads, tileRows)
+
+    return imageLoader.loadImageChannels(filePath, datatype, debayerChannels, precision, bitDepth)
+
+# Crop-first RAW processing: The brightest area is searched on a cheap green preview (2x2 binned) of the speckle RAW image.
+# Only a BGGR-aligned window around it (twice the crop size for the 45° rotated green channel, plus margin) is normalized and debayered
+# in the speckle- and the reference-image. Returns the debayered windows (refImg is None without reference) and the crop size of the full image.
+def loadRawWindowsCropFirst(imgPath, refPath, debayerChannel="g", useRefImg=True, margin=CROP_FIRST_MARGIN, precision="uint8", bitDepth=None):
+    import rawpy
+    with profileStage("decode"):
+        rawImg = rawpy.imread(imgPath)
+    with rawImg:
+        bayerpattern = rawImg.raw_pattern
+        rawShape = rawImg.raw_image_visible.shape
+        cropSize = getCropSize(getDebayeredShape(rawShape, bayerpattern, debayerChannel)[1])
+
+        # A rotated square of the green channel covers half of its area in raw pixels
+        with profileStage("find brightest area (preview)"):
+            preview = createGreenPreview(rawImg.raw_image_visible, bayerpattern)
+            previewSize = int(round(cropSize / np.sqrt(2))) if debayerChannel.lower() == "g" else cropSize
+            previewSize = max(min(previewSize, *preview.shape), 1)
+            previewX, previewY, _, _ = findBrightestArea(preview, (previewSize, previewSize))
+
+        offsetY, offsetX = getBggrOffset(bayerpattern)
+        center = (offsetY + 2*previewY + previewSize, offsetX + 2*previewX + previewSize)
+        window = getRawAnalysisWindow(rawShape, bayerpattern, center, 2*cropSize + 2*margin)
+        print(" > Processing window " + str(window) + " of " + str(rawShape))
+        img = processRawImageWindow(rawImg, window, debayerChannel, precision, bitDepth)
+
+    refImg = None
+    if useRefImg:
+        with profileStage("decode"):
+            rawRef = rawpy.imread(refPath)
+        with rawRef:
+            if rawRef.raw_image_visible.shape != rawShape or not np.array_equal(rawRef.raw_pattern, bayerpattern):
+                raise Exception(" ! Reference '" + refPath + "' doesn't have the same sensor layout as the speckle image.")
+            refImg = processRawImageWindow(rawRef, window, debayerChannel, precision, bitDepth)
+
+    return img, refImg, cropSize
+
+# Returns the reference image of a batch, the last REFERENCE_CACHE_SIZE references are kept in memory (refStamp: see getFileStamp())
+@functools.lru_cache(maxsize=REFERENCE_CACHE_SIZE)
+def getCachedReferenceImage(refPath, refStamp, datatype, debayerChannel, useCache, precision="uint8", bitDepth=None, rawThreads=None, tileRows=None):
+    refImg = loadImageChannel(refPath, datatype, debayerChannel, useCache, precision, bitDepth, rawThreads, tileRows)
+    if refImg is not None:
+        refImg.flags.writeable = False
+    return refImg
+
+# Returns calculateReferenceSpeckle() for a crop of a reference image, the last REFERENCE_CROP_CACHE_SIZE results are kept in memory
+@functools.lru_cache(maxsize=REFERENCE_CROP_CACHE_SIZE)
+def getCachedReferenceSpeckle(refPath, refStamp, datatype, debayerChannel, useCache, cropFilter, perforationThreshold=None, filterMode="flat", filterBackend="scipy", precision="uint8", bitDepth=None,
+                              rawThreads=None, tileRows=None):
+    with profileStage("load reference"):
+        refImg = getCachedReferenceImage(refPath, refStamp, datatype, debayerChannel, useCache, precision, bitDepth, rawThreads, tileRows)
+    if refImg is None:
+        raise Exception(" ! Reference '" + refPath + "' couldn't be loaded.")
+    _, whiteValue = getPrecision(precision, bitDepth)
+    perfMask, refImgFlatMasked, refSpeckleFiltered = calculateReferenceSpeckle(cropImage(refImg, cropFilter), perforationThreshold, filterMode, filterBackend, whiteValue=whiteValue)
+    perfMask.flags.writeable = False
+    refImgFlatMasked.flags.writeable = False
+    return perfMask, refImgFlatMasked, refSpeckleFiltered
+
+# Frees the references kept in memory
+def clearReferenceCache():
+    getCachedReferenceImage.cache_clear()
+    getCachedReferenceSpeckle.cache_clear()
+
+# Returns (modification time, size) of a file as part of the reference cache keys, so a reference that is captured again under the same name
+# isn't served from the cache (e.g. in the long-lived workers of asyncPipeline.analyzeStream()). None if the file doesn't exist.
+def getFileStamp(filePath):
+    try:
+        fileStat = os.stat(filePath)
+    except OSError:
+        return None
+    return (fileStat.st_mtime_ns, fileStat.st_size)
 
 # -----------------
 # - KEY FUNCTIONS -
 # -----------------
 
-# Finds the brightest area (based on given size) in an image 
-# Returns a filter that can be used to crop images using the cropImage(img, cropFilter) method
-def findBrightestArea(image, areaSize, debug=False):
-    # Calculate integral image
-    integralImage = cv2.integral(image)
-    areaWidth, areaHeight = areaSize
-
-    # Calculate sum of given area
-    def sumArea(integralImg, x, y, w, h):
-        botRight = integralImg[y+h, x+w]
-        botLeft = integralImg[y+h, x]
-        topRight = integralImg[y, x+w]
-        topLeft = integralImg[y, x]
-        return botRight - botLeft - topRight + topLeft
-    
-    maxSum = maxX = maxY = -1
-    imgHeight, imgWidth = image.shape[:2]
-
-    # Slide a window over the image and find the max sum
-    for y in range(imgHeight - areaHeight + 1):
-        for x in range(imgWidth - areaWidth + 1):
-            currentSum = sumArea(integralImage, x, y, areaWidth, areaHeight)
-            if currentSum > maxSum:
-                maxSum = currentSum
-                maxX, maxY = x, y
-
-    if debug:
-         # Highlight the brightest area on the original image
-        brightestArea = image[maxY:maxY+areaHeight, maxX:maxX+areaWidth].copy()
-
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-
-        scale = 0.5
-        cv2.rectangle(image, (maxX, maxY), (maxX + areaWidth, maxY + areaHeight), (0, 255, 0), 2)
-        cv2.imshow('Image with brightest area highlighted', cv2.resize(image, (0,0), fx=scale, fy=scale))
-        cv2.imshow('Brightest area', brightestArea)
-        cv2.waitKey(0)
-        cv2.destroyAllWindows()
-
-    cropFilter = [maxX, maxY, areaWidth, areaHeight]
-    return cropFilter
-
-# Crops the given image based on the given crop filter
-def cropImage(img, cropFilter):
-    maxX, maxY, width, height = cropFilter
-    return img[maxY:maxY+height, maxX:maxX+width].copy()
-
-# Returns a perforation mask based on a given threshold
-def getImagePerforationMask(img, threshold, erosionSize=2):
-    _, perfMask = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
-    perfMask = cv2.erode(perfMask, np.ones((erosionSize,erosionSize), np.uint8))
-    return perfMask
-
 # Finds perforations in an image based on a brightness-threshold
-def findPerforations(img):
+# If a threshold (number or one of PERFORATION_THRESHOLD_METHODS) is given the mask is generated directly without opening the threshold-slider.
+# matplotlib is only imported for the threshold-slider.
+# The threshold is in the 0-255 range, images with another white value (see rawProcessor.getPrecision()) are scaled to it in float32.
+def findPerforations(img, threshold=None, whiteValue=255):
+    img = np.asarray(img)
+    if whiteValue != 255 or img.dtype not in (np.uint8, np.float32):
+        img = np.multiply(img, np.float32(255/whiteValue), dtype=np.float32)
+    if threshold in PERFORATION_THRESHOLD_METHODS:
+        threshold = findPerforationThreshold(img, threshold)
+    if threshold is not None:
+        return getImagePerforationMask(img, threshold)
+
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Button, Slider
+
     initialThreshold = 30
     perfMask = getImagePerforationMask(img, initialThreshold)
     updatedPerfMask = [perfMask]
@@ -185,77 +538,81 @@ def findPerforations(img):
 
     return updatedPerfMask[0] 
 
-# Reduces a given 2D-Array to a 1D-Array. 
-# A mask can be given to exclude pixels of the input-image from the flattened image    
-def flattenImage(img, mask=None, debug=False):
-    flat = []
-    debugImg = []
-    for idxY, y in enumerate(img):
-        debugImg.append([])
-        for idxX, x in enumerate(y):
-            if type(mask) == type(None) or mask[idxY][idxX] > 0:
-                flat.append(x)
-                debugImg[idxY].append(int(x))
-            else:
-                debugImg[idxY].append(int(0))
-    if debug:
-        debugShowImg(debugImg, "Masked Image", debug)
-    return flat
-
-
-# Calculates the speckle contrast of a given image
-def calculateSpeckleContrast(img):
-    return np.std(img) / np.average(img) * 100
+# Calculates the perforation mask and the filtered reference speckle of a cropped reference image
+# Returns the perforation mask, the flattened masked reference image and the filtered reference speckle
+# A given perfMask is used instead of generating one
+def calculateReferenceSpeckle(refImageCropped, perforationThreshold=None, filterMode="flat", filterBackend="scipy", perfMask=None, whiteValue=255):
+    if perfMask is None:
+        with profileStage("perforation mask"):
+            perfMask = findPerforations(refImageCropped, perforationThreshold, whiteValue)
 
+    # Mask and flatten ref image
+    with profileStage("flatten"):
+        refImgFlatMasked = flattenImage(refImageCropped, perfMask)
 
-# Calculates the speckle values for the given image and returns them
-def calculateProjectionSpeckle(refImage=None, speckleImage=None, useRefImg=True):
+    # Highpass filter to remove global intensity variations
+    kernelSize = 9
+    with profileStage("highpass"):
+        if filterMode == "2d":
+            imgHighPass = highPassFilter2D(refImageCropped, perfMask, kernelSize, filterBackend)
+        else:
+            imgHighPass = highPassFilterFlat(refImgFlatMasked, kernelSize, avoidZero=False)
+
+    # Calculate reference speckle
+    refSpeckleFiltered = calculateSpeckleContrast(imgHighPass)
+    return perfMask, refImgFlatMasked, refSpeckleFiltered
+
+# filterMode selects the highpass filter (see FILTER_MODES), filterBackend the kernel backend of the "2d" mode (see FILTER_BACKENDS)
+# perforationThreshold is passed to findPerforations(), the threshold is chosen interactively if it is None
+# referenceProvider can replace the reference processing: it is called with the crop filter and returns the same as calculateReferenceSpeckle()
+# cropSize overrides the size of the analyzed area, e.g. if the images are windows of a larger image
+# cropFilter and perfMask can be given to reuse the analyzed area and the perforation mask of another channel of the same image
+# whiteValue is the white level of the images (see rawProcessor.getPrecision()), the perforationThreshold is scaled from 0-255 to it
+# coarseStep is passed to findBrightestArea() (coarse-to-fine search with coarseStep > 1)
+def calculateProjectionSpeckle(refImage=None, speckleImage=None, useRefImg=True, filterMode="flat", filterBackend="scipy", perforationThreshold=None, referenceProvider=None, cropSize=None, cropFilter=None, perfMask=None, whiteValue=255,
+                               coarseStep=1):
+    if filterMode not in FILTER_MODES:
+        raise Exception(" ! '" + str(filterMode) + "' is not a valid filter mode. Use one of " + str(FILTER_MODES) + ".")
     
     # The area that the image is being cropped to is based on the width of the image
-    imgWidth = np.array(speckleImage).shape[1]
-    scaledCropSize = int(imgWidth/9)
-    cropAreaHeight = cropAreaWith = scaledCropSize if scaledCropSize >= 400 else 400
+    if cropSize is None:
+        cropSize = getCropSize(np.shape(speckleImage)[1])
+    cropAreaHeight = cropAreaWith = cropSize
 
     # -- CROPPING BASED ON BRIGHTEST AREA --
     # Find the brightest area and crop it out of the reference- and speckle-image
-    print(" > Finding brightest area")
-    cropFilter = findBrightestArea(speckleImage, (cropAreaHeight, cropAreaWith))
-    if refImage is not None:
-        refImageCropped = cropImage(refImage, cropFilter)
-    speckleImageCropped = cropImage(speckleImage, cropFilter)
-
-    # -- GENERATE PERFORATION MASK --
+    if cropFilter is None:
+        print(" > Finding brightest area")
+        with profileStage("find brightest area"):
+            cropFilter = findBrightestArea(speckleImage, (cropAreaHeight, cropAreaWith), coarseStep=coarseStep)
+    with profileStage("crop"):
+        speckleImageCropped = cropImage(speckleImage, cropFilter)
+
+    # -- GENERATE PERFORATION MASK AND CALCULATE REFERENCE SPECKLE --
     # Generate perforation mask // Fill mask with white if there is no reference
     print(" > Generating perforation mask")
-    perfMask = None
-    if useRefImg:
-        perfMask = findPerforations(refImageCropped)
+    if useRefImg and referenceProvider is not None:
+        with profileStage("reference speckle"):
+            perfMask, refImgFlatMasked, refSpeckleFiltered = referenceProvider(cropFilter)
+    elif useRefImg:
+        with profileStage("reference speckle"):
+            refImageCropped = cropImage(refImage, cropFilter)
+            perfMask, refImgFlatMasked, refSpeckleFiltered = calculateReferenceSpeckle(refImageCropped, perforationThreshold, filterMode, filterBackend, perfMask, whiteValue)
     else:
-        perfMask = np.full((cropAreaHeight, cropAreaWith), 255)
+        perfMask = np.full((cropAreaHeight, cropAreaWith), 255, dtype=np.uint8)
+        refImgFlatMasked = None
+        refSpeckleFiltered = -1
 
     print("\nResults:")
-
-    # -- CALCULATE REFERENCE SPECKLE --
     if useRefImg:
-        # Mask and flatten ref image
-        refImgFlatMasked = flattenImage(refImageCropped, perfMask)
-
-        # Highpass filter to remove global intensity variations
-        kernelSize = 9
-        imgLowPass = ndimage.gaussian_filter(refImgFlatMasked, kernelSize, mode = 'mirror')
-        imgHighPass = np.divide(refImgFlatMasked,imgLowPass)
-
-        # Calculate reference speckle
-        refSpeckleFiltered = calculateSpeckleContrast(imgHighPass)
         printResultFormatted(refSpeckleFiltered, "Referencespeckle (filtered)")
-    else:
-        refSpeckleFiltered = -1
 
     # -----------------
     # Calculate Speckle
     # -----------------
     # Mask and flatten speckle image
-    speckleImgFlatMasked = flattenImage(speckleImageCropped, perfMask, debug=False)
+    with profileStage("flatten"):
+        speckleImgFlatMasked = flattenImage(speckleImageCropped, perfMask, debug=False)
 
     # -- CALCULATE RAW SPECKLE --
     speckleRaw = calculateSpeckleContrast(speckleImgFlatMasked)
@@ -263,10 +620,11 @@ def calculateProjectionSpeckle(refImage=None, speckleImage=None, useRefImg=True)
 
     # Highpass filter to remove global intensity variations
     kernelSize = 9
-    imgLowPass = ndimage.gaussian_filter(speckleImgFlatMasked, kernelSize, mode = 'mirror')
-    if 0 in imgLowPass:
-        imgLowPass += 1
-    imgHighPass = np.divide(speckleImgFlatMasked,imgLowPass)
+    with profileStage("highpass"):
+        if filterMode == "2d":
+            imgHighPass = highPassFilter2D(speckleImageCropped, perfMask, kernelSize, filterBackend)
+        else:
+            imgHighPass = highPassFilterFlat(speckleImgFlatMasked, kernelSize)
     
     # -- CALCULATE FILTERED SPECKLE --
     speckleFiltered = calculateSpeckleContrast(imgHighPass)
@@ -293,12 +651,5 @@ def calculateProjectionSpeckle(refImage=None, speckleImage=None, useRefImg=True)
 # - SUPPORT FUNCTIONS -
 # ---------------------
 
-# Opens a window and displays the given image
-def debugShowImg(img, title="Debug", debug=True):
-    if debug:
-        cv2.imshow(title, np.array(img))
-        cv2.waitKey(0)
-        cv2.destroyAllWindows()
-
 def printResultFormatted(value, title, round=2):
     print("{:<5} {:<15}".format(f"{value:.2f}%", title))
\ No newline at end of file
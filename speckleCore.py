@@ -0,0 +1,227 @@
+import numpy as np
+
+'''
+Numeric core of the speckle calculation: brightest area, crop, perforation mask, flatten, highpass filter and contrast.
+Only numpy is imported with this module. OpenCV and scipy are imported by the functions that use them,
+so processes that only need a part of the pipeline (or cameraSettingCalculator) start fast.
+RAW decoding is in rawProcessor.py, loading, the threshold-slider and the measurement workflow in speckleCalculator.py.
+'''
+
+# Modes for the highpass filter in calculateProjectionSpeckle()
+# "flat": Gaussian lowpass on the flattened (masked) pixels
+# "2d": Gaussian lowpass on the 2D crop with normalized convolution, masked pixels don't contribute
+FILTER_MODES = ["flat", "2d"]
+# Kernel backends for the "2d" filter mode
+FILTER_BACKENDS = ["scipy", "opencv", "fft"]
+# Methods to find the perforation threshold automatically, can be used instead of a fixed perforationThreshold
+PERFORATION_THRESHOLD_METHODS = ["otsu", "valley"]
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Finds the brightest area (based on given size) in an image 
+# Returns a filter that can be used to crop images using the cropImage(img, cropFilter) method
+# With coarseStep > 1 the search is coarse-to-fine: first only every coarseStep-th window position is evaluated, then the positions around the best one.
+# Instead of searching a downsampled image, the coarse pass uses the exact window sums on a grid of positions of the same integral image,
+# so no second image is created (crop-first processing already searches a 2x2 binned preview, see speckleCalculator.loadRawWindowsCropFirst()).
+# This is faster on large images but may miss the exact maximum, coarseStep=1 always matches the exhaustive search.
+def findBrightestArea(image, areaSize, debug=False, coarseStep=1):
+    import cv2
+    # Calculate integral image, cv2.integral() takes 8 bit, 16 bit (summed as float64) or float images
+    if image.dtype in (np.uint16, np.int16):
+        integralImage = cv2.integral(image, sdepth=cv2.CV_64F)
+    else:
+        integralImage = cv2.integral(image if image.dtype in (np.uint8, np.float32, np.float64) else image.astype(np.float32))
+    areaWidth, areaHeight = areaSize
+    imgHeight, imgWidth = image.shape[:2]
+    maxX = maxY = -1
+
+    if imgHeight >= areaHeight and imgWidth >= areaWidth:
+        if coarseStep > 1:
+            # Coarse search on a grid of window positions
+            coarseSums = sumAllAreas(integralImage, areaWidth, areaHeight, step=coarseStep)
+            coarseY, coarseX = np.unravel_index(np.argmax(coarseSums), coarseSums.shape)
+            coarseY, coarseX = int(coarseY), int(coarseX)
+
+            # Refine around the best coarse position
+            startY = max(coarseY*coarseStep - coarseStep + 1, 0)
+            startX = max(coarseX*coarseStep - coarseStep + 1, 0)
+            endY = min(coarseY*coarseStep + coarseStep, imgHeight - areaHeight + 1)
+            endX = min(coarseX*coarseStep + coarseStep, imgWidth - areaWidth + 1)
+            integralImage = integralImage[startY:endY+areaHeight, startX:endX+areaWidth]
+        else:
+            startY = startX = 0
+
+        # Sum of every window position at once, the first maximum wins
+        areaSums = sumAllAreas(integralImage, areaWidth, areaHeight)
+        maxY, maxX = np.unravel_index(np.argmax(areaSums), areaSums.shape)
+        maxY, maxX = int(maxY) + startY, int(maxX) + startX
+
+    if debug:
+         # Highlight the brightest area on the original image
+        brightestArea = image[maxY:maxY+areaHeight, maxX:maxX+areaWidth].copy()
+
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+
+        scale = 0.5
+        cv2.rectangle(image, (maxX, maxY), (maxX + areaWidth, maxY + areaHeight), (0, 255, 0), 2)
+        cv2.imshow('Image with brightest area highlighted', cv2.resize(image, (0,0), fx=scale, fy=scale))
+        cv2.imshow('Brightest area', brightestArea)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+    cropFilter = [maxX, maxY, areaWidth, areaHeight]
+    return cropFilter
+
+# Returns the sums of all areas of the given size for every (y, x) window position (optionally on a grid with the given step)
+def sumAllAreas(integralImg, areaWidth, areaHeight, step=1):
+    positionsY = integralImg.shape[0] - areaHeight
+    positionsX = integralImg.shape[1] - areaWidth
+    botRight = integralImg[areaHeight:areaHeight+positionsY:step, areaWidth:areaWidth+positionsX:step]
+    botLeft = integralImg[areaHeight:areaHeight+positionsY:step, :positionsX:step]
+    topRight = integralImg[:positionsY:step, areaWidth:areaWidth+positionsX:step]
+    topLeft = integralImg[:positionsY:step, :positionsX:step]
+
+    areaSums = np.subtract(botRight, botLeft)
+    areaSums -= topRight
+    areaSums += topLeft
+    return areaSums
+
+# Crops the given image based on the given crop filter
+def cropImage(img, cropFilter):
+    maxX, maxY, width, height = cropFilter
+    return img[maxY:maxY+height, maxX:maxX+width].copy()
+
+# Returns a perforation mask (uint8, 0 or 255) based on a given threshold
+def getImagePerforationMask(img, threshold, erosionSize=2):
+    import cv2
+    _, perfMask = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
+    perfMask = cv2.erode(perfMask, np.ones((erosionSize,erosionSize), np.uint8))
+    return perfMask.astype(np.uint8, copy=False)
+
+# Finds the threshold between the dark perforations and the bright screen automatically
+# "otsu": Otsu's method, "valley": deepest point of the smoothed histogram between its two highest peaks (falls back to Otsu)
+def findPerforationThreshold(img, method="otsu"):
+    import cv2
+    from scipy import ndimage
+    if method not in PERFORATION_THRESHOLD_METHODS:
+        raise Exception(" ! '" + str(method) + "' is not a valid threshold method. Use one of " + str(PERFORATION_THRESHOLD_METHODS) + ".")
+
+    img = np.asarray(img, dtype=np.uint8)
+    threshold, _ = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    if method == "valley":
+        histogram = ndimage.gaussian_filter1d(np.bincount(img.ravel(), minlength=256).astype(np.float64), 2)
+        isPeak = (histogram[1:-1] > histogram[:-2]) & (histogram[1:-1] >= histogram[2:])
+        peaks = np.flatnonzero(isPeak) + 1
+        if len(peaks) >= 2:
+            darkPeak, brightPeak = np.sort(peaks[np.argsort(histogram[peaks])[-2:]])
+            valley = histogram[darkPeak:brightPeak+1]
+            valleyBottom = np.flatnonzero(valley == valley.min())
+            threshold = darkPeak + (valleyBottom[0] + valleyBottom[-1]) // 2
+
+    print(" > Perforation threshold (" + method + "): " + str(int(threshold)))
+    return int(threshold)
+
+# Reduces a given 2D-Array to a 1D-Array. 
+# A mask can be given to exclude pixels of the input-image from the flattened image
+# Without a mask the returned array is a view of the (contiguous) input image
+def flattenImage(img, mask=None, debug=False):
+    img = np.asarray(img)
+    if mask is None:
+        flat = img.ravel()
+    else:
+        maskSelection = np.asarray(mask) > 0
+        flat = img[maskSelection]
+
+    if debug:
+        debugImg = img if mask is None else np.where(maskSelection, img, 0).astype(img.dtype)
+        debugShowImg(debugImg, "Masked Image", debug)
+    return flat
+
+
+# Calculates the speckle contrast of a given image
+def calculateSpeckleContrast(img):
+    return np.std(img, dtype=np.float64) / np.mean(img, dtype=np.float64) * 100
+
+
+# Highpass filters a 2D image by dividing it by its Gaussian lowpass. Returns the filtered values of all unmasked pixels.
+# The lowpass is a normalized convolution (blur(img*mask) / blur(mask)), so masked pixels don't pollute their neighbours.
+def highPassFilter2D(img, mask=None, kernelSize=9, backend="scipy"):
+    if backend not in FILTER_BACKENDS:
+        raise Exception(" ! '" + str(backend) + "' is not a valid filter backend. Use one of " + str(FILTER_BACKENDS) + ".")
+
+    # Preallocated float32 buffers
+    imgFloat = np.asarray(img, dtype=np.float32)
+    lowPass = np.empty(imgFloat.shape, dtype=np.float32)
+
+    if mask is None:
+        gaussianBlur(imgFloat, kernelSize, backend, out=lowPass)
+        validPixels = None
+    else:
+        validPixels = np.asarray(mask) > 0
+        weights = validPixels.astype(np.float32)
+        weightsLowPass = np.empty(imgFloat.shape, dtype=np.float32)
+        gaussianBlur(weights, kernelSize, backend, out=weightsLowPass)
+        np.multiply(imgFloat, weights, out=weights)
+        gaussianBlur(weights, kernelSize, backend, out=lowPass)
+        np.divide(lowPass, weightsLowPass, out=lowPass, where=validPixels)
+
+    imgHighPass = imgFloat if validPixels is None else imgFloat[validPixels]
+    imgLowPass = lowPass if validPixels is None else lowPass[validPixels]
+    if 0 in imgLowPass:
+        imgLowPass += 1
+    return np.divide(imgHighPass.ravel(), imgLowPass.ravel(), dtype=np.float32)
+
+# Highpass filters flattened pixels by dividing them by their Gaussian lowpass ("flat" filter mode of calculateProjectionSpeckle())
+# With avoidZero a lowpass containing 0 is raised by 1, so no pixel is divided by 0
+def highPassFilterFlat(imgFlat, kernelSize=9, avoidZero=True):
+    from scipy import ndimage
+    imgLowPass = ndimage.gaussian_filter(imgFlat, kernelSize, mode = 'mirror', output=getLowPassType(imgFlat))
+    if avoidZero and 0 in imgLowPass:
+        imgLowPass += 1
+    return np.divide(imgFlat, imgLowPass)
+
+# Returns the type of the lowpass of the "flat" filter mode: uint8 images keep the uint8 lowpass of the original implementation,
+# all other images are filtered in float32 (the highpass is then float32 as well)
+def getLowPassType(img):
+    return np.uint8 if img.dtype == np.uint8 else np.float32
+
+# Gaussian blur with mirrored borders (same as ndimage mode 'mirror') using the given backend
+def gaussianBlur(img, sigma, backend="scipy", out=None, truncate=4.0):
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+
+    if backend == "opencv":
+        import cv2
+        kernelWidth = 2*int(truncate*sigma + 0.5) + 1
+        cv2.GaussianBlur(img, (kernelWidth, kernelWidth), sigma, dst=out, borderType=cv2.BORDER_REFLECT_101)
+    elif backend == "fft":
+        from scipy import signal
+        radius = int(truncate*sigma + 0.5)
+        kernel1D = np.exp(-0.5 * (np.arange(-radius, radius+1, dtype=np.float64) / sigma)**2)
+        kernel1D = (kernel1D / kernel1D.sum()).astype(np.float32)
+        paddedImg = np.pad(img, radius, mode="reflect")
+        out[...] = signal.fftconvolve(paddedImg, np.outer(kernel1D, kernel1D), mode="valid")
+    else:
+        from scipy import ndimage
+        ndimage.gaussian_filter(img, sigma, mode='mirror', output=out, truncate=truncate)
+    return out
+
+# Returns the size of the analyzed area for an image of the given width
+def getCropSize(imgWidth):
+    scaledCropSize = int(imgWidth/9)
+    return scaledCropSize if scaledCropSize >= 400 else 400
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+# Opens a window and displays the given image
+def debugShowImg(img, title="Debug", debug=True):
+    if debug:
+        import cv2
+        cv2.imshow(title, np.array(img))
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
@@ -0,0 +1,108 @@
+import contextlib
+import contextvars
+import logging
+import time
+import tracemalloc
+
+'''
+Timing and memory instrumentation of the pipeline stages.
+Stages are marked with "with profileStage(name):". Without an active profiler this is a shared no-op context manager.
+A profiler is activated for a block with "with activateProfiler(StageProfiler()):" and records wall time, CPU time
+and peak allocated bytes (tracemalloc, includes numpy arrays) of every stage in that block. Stages can be nested.
+Every finished stage is also logged with the logger "stageProfiler" (level INFO).
+'''
+
+logger = logging.getLogger("stageProfiler")
+activeProfiler = contextvars.ContextVar("activeProfiler", default=None)
+NO_STAGE = contextlib.nullcontext()
+
+# ------------------------
+# - ACTIVATION FUNCTIONS -
+# ------------------------
+
+# Marks a stage of the pipeline for the active profiler
+def profileStage(name):
+    profiler = activeProfiler.get()
+    if profiler is None:
+        return NO_STAGE
+    return profiler.stage(name)
+
+# Activates the profiler for the following block, None keeps profiling disabled
+@contextlib.contextmanager
+def activateProfiler(profiler):
+    if profiler is None:
+        yield None
+        return
+
+    startedTracing = profiler.traceMemory and not tracemalloc.is_tracing()
+    if startedTracing:
+        tracemalloc.start()
+    token = activeProfiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        activeProfiler.reset(token)
+        if startedTracing:
+            tracemalloc.stop()
+
+# -----------------
+# - KEY FUNCTIONS -
+# -----------------
+
+# Records the stages as dicts with "stage", "depth", "wallTime" and "cpuTime" (in s) and "peakBytes"
+# peakBytes is the peak of memory allocated during the stage on top of the memory at its start (None without traceMemory)
+class StageProfiler:
+    def __init__(self, traceMemory=True):
+        self.traceMemory = traceMemory
+        self.records = []
+        self.openStages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"stage": name, "depth": len(self.openStages), "wallTime": None, "cpuTime": None, "peakBytes": None}
+        self.records.append(record)
+        tracing = self.traceMemory and tracemalloc.is_tracing()
+
+        # The peak is reset for every stage, so the enclosing stage keeps the peak it has seen so far
+        if tracing:
+            startBytes, peakBytes = tracemalloc.get_traced_memory()
+            if self.openStages:
+                self.openStages[-1]["observedPeak"] = max(self.openStages[-1]["observedPeak"], peakBytes)
+            tracemalloc.reset_peak()
+        openStage = {"startBytes": startBytes if tracing else 0, "observedPeak": 0}
+        self.openStages.append(openStage)
+
+        startWall = time.perf_counter()
+        startCpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wallTime"] = time.perf_counter() - startWall
+            record["cpuTime"] = time.process_time() - startCpu
+            self.openStages.pop()
+            if tracing:
+                peakBytes = max(tracemalloc.get_traced_memory()[1], openStage["observedPeak"])
+                record["peakBytes"] = max(peakBytes - openStage["startBytes"], 0)
+                if self.openStages:
+                    self.openStages[-1]["observedPeak"] = max(self.openStages[-1]["observedPeak"], peakBytes)
+            logger.info(formatRecord(record))
+
+    # Returns the summed wall time, CPU time and maximal peak per stage name
+    def summary(self):
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(record["stage"], {"calls": 0, "wallTime": 0.0, "cpuTime": 0.0, "peakBytes": None})
+            stage["calls"] += 1
+            stage["wallTime"] += record["wallTime"] or 0.0
+            stage["cpuTime"] += record["cpuTime"] or 0.0
+            if record["peakBytes"] is not None:
+                stage["peakBytes"] = max(stage["peakBytes"] or 0, record["peakBytes"])
+        return stages
+
+# ---------------------
+# - SUPPORT FUNCTIONS -
+# ---------------------
+
+def formatRecord(record):
+    peak = "" if record["peakBytes"] is None else " peak {:.1f} MB".format(record["peakBytes"]/1024**2)
+    return "{}{}: wall {:.1f} ms, cpu {:.1f} ms{}".format("  "*record["depth"], record["stage"], record["wallTime"]*1000, record["cpuTime"]*1000, peak)
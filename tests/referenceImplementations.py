@@ -0,0 +1,105 @@
+import numpy as np
+import re
+import math
+from rawProcessor import RED, GREEN_1, GREEN_2, BLUE
+
+'''
+Previous (pure-Python) implementations of vectorized functions. They are the reference the regression tests compare against,
+benchmark.py times them against the current implementations.
+'''
+
+# Previous implementation of debayerSingleColor() (pixel by pixel, always uint8)
+def debayerSingleColorLoop(bggrImg, debayerChannel):
+    bggrImg = np.array(bggrImg)
+    imgHeight, imgWidth = bggrImg.shape[:2]
+
+    if re.search('g', debayerChannel, re.IGNORECASE):
+        newWidth = math.ceil((imgHeight + imgWidth)/2)
+        newHeight = newWidth-1
+        rotImage = np.zeros((newHeight, newWidth), dtype=np.uint8)
+        for y in range(imgHeight):
+            for x in range(imgWidth):
+                # If its a green pixel put it at the rotated location (BGGR)
+                if (y % 2 == 0 and x % 2 == 1) or (y % 2 == 1 and x % 2 == 0):
+                    newY = math.ceil((y + x)/2)-1
+                    newX = math.ceil((imgWidth - 1 - x + y)/2)
+                    rotImage[newY][newX] = bggrImg[y][x]
+        return rotImage
+
+    newHeight = math.ceil(imgHeight/2 + 1)
+    newWidth = math.ceil(imgWidth/2 + 1)
+    debayeredImage = np.zeros((newHeight, newWidth), dtype=np.uint8)
+    isRedDebayer = re.search('r', debayerChannel, re.IGNORECASE)
+    isBlueDebayer = re.search('b', debayerChannel, re.IGNORECASE)
+    for y in range(imgHeight):
+        for x in range(imgWidth):
+            # If its a red or blue pixel store it in the corresponding new image (BGGR)
+            if (isBlueDebayer and (y % 2 == 0 and x % 2 == 0)) or (isRedDebayer and (y % 2 == 1 and x % 2 == 1)):
+                newY = math.ceil((y)/2)
+                newX = math.ceil((x)/2)
+                debayeredImage[newY][newX] = bggrImg[y][x]
+    return debayeredImage
+
+# Original implementation of normalizeRawImage(): clamps the raw image in place with equal black levels, normalizes pixel by pixel otherwise
+def normalizeRawImageLoop(rawImage, bayerpattern, blacklevel, whitelevel, type=np.uint8):
+    if bayerpattern[0][0] == GREEN_1 or bayerpattern[0][0] == GREEN_2:
+        if bayerpattern[0][1] == BLUE:
+            rawImage = rawImage[:, 1:-1]
+        else:
+            rawImage = rawImage[1:-1]
+    elif bayerpattern[0][0] == RED:
+        rawImage = rawImage[1:-1, 1:-1]
+
+    blackR = blacklevel[RED]
+    blackG = blacklevel[GREEN_1]
+    blackB = blacklevel[BLUE]
+    whiteR = whitelevel[RED] - blackR
+    whiteG = whitelevel[GREEN_1] - blackG
+    whiteB = whitelevel[BLUE] - blackB
+
+    if blackR != blackG or blackB != blackR:
+        normalizedImage = []
+        for y, yVal in enumerate(rawImage):
+            normalizedImage.append([])
+            for x, xVal in enumerate(yVal):
+                if (y % 2 == 0 and x % 2 == 1) or (y % 2 == 1 and x % 2 == 0):
+                    # GREEN
+                    normalizedImage[y].append(((xVal-blackG)/whiteG * 255).astype(type))
+                elif (y % 2 == 0 and x % 2 == 0):
+                    # BLUE
+                    normalizedImage[y].append(((xVal-blackB)/whiteB * 255).astype(type))
+                else:
+                    # RED
+                    normalizedImage[y].append(((xVal-blackR)/whiteR * 255).astype(type))
+    else:
+        rawImage[rawImage <= blackR] = blackR # Prevent underflowing
+        normalizedImage = ((rawImage-blackR) / (whiteR) * 255).astype(type)
+
+    return np.array(normalizedImage)
+
+# Original implementation of findBrightestArea(): sums every window position one after another (integral image with numpy instead of cv2.integral())
+def findBrightestAreaLoop(image, areaSize):
+    integralImage = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=np.float64)
+    integralImage[1:, 1:] = np.cumsum(np.cumsum(image, axis=0, dtype=np.float64), axis=1)
+    areaWidth, areaHeight = areaSize
+
+    # Calculate sum of given area
+    def sumArea(integralImg, x, y, w, h):
+        botRight = integralImg[y+h, x+w]
+        botLeft = integralImg[y+h, x]
+        topRight = integralImg[y, x+w]
+        topLeft = integralImg[y, x]
+        return botRight - botLeft - topRight + topLeft
+
+    maxSum = maxX = maxY = -1
+    imgHeight, imgWidth = image.shape[:2]
+
+    # Slide a window over the image and find the max sum
+    for y in range(imgHeight - areaHeight + 1):
+        for x in range(imgWidth - areaWidth + 1):
+            currentSum = sumArea(integralImage, x, y, areaWidth, areaHeight)
+            if currentSum > maxSum:
+                maxSum = currentSum
+                maxX, maxY = x, y
+
+    return [maxX, maxY, areaWidth, areaHeight]
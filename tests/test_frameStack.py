@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import imageLoader
+from frameStack import RunningStatistics, calculateTemporalContrast, getMeanImage
+
+'''
+Tests of the single pass stack statistics against numpy over the stacked frames and of the per-frame stack loading.
+'''
+
+def createStack(frameCount, shape=(12, 17), seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.uniform(20, 200, shape)
+    return base * (1 + 0.2 * rng.standard_normal((frameCount,) + shape))
+
+def accumulate(frames):
+    statistics = RunningStatistics()
+    for frame in frames:
+        statistics.update(frame)
+    return statistics
+
+@pytest.mark.parametrize("frameCount", [1, 2, 3, 10, 57])
+@pytest.mark.parametrize("ddof", [0, 1])
+def test_runningStatisticsMatchesNumpy(frameCount, ddof):
+    stack = createStack(frameCount)
+    statistics = accumulate(stack)
+    assert statistics.count == frameCount
+    assert np.allclose(statistics.mean, np.mean(stack, axis=0), rtol=1e-12)
+    if frameCount > ddof:
+        assert np.allclose(statistics.variance(ddof), np.var(stack, axis=0, ddof=ddof), rtol=1e-10)
+        assert np.allclose(statistics.std(ddof), np.std(stack, axis=0, ddof=ddof), rtol=1e-10)
+    else:
+        assert np.all(np.isnan(statistics.variance(ddof)))
+
+def test_runningStatisticsScalars():
+    values = [3.5, 1.25, 8.0, 8.0, -2.0]
+    statistics = accumulate(values)
+    assert statistics.mean == pytest.approx(np.mean(values))
+    assert statistics.variance() == pytest.approx(np.var(values))
+    assert statistics.std(ddof=1) == pytest.approx(np.std(values, ddof=1))
+
+# Integer frames are accumulated in float64 and don't overflow
+def test_runningStatisticsIntegerFrames():
+    stack = np.random.default_rng(3).integers(0, 65535, (20, 8, 9), dtype=np.uint16, endpoint=True)
+    statistics = accumulate(stack)
+    assert np.allclose(statistics.mean, np.mean(stack, axis=0, dtype=np.float64))
+    assert np.allclose(statistics.variance(), np.var(stack, axis=0, dtype=np.float64))
+
+def test_runningStatisticsEmpty():
+    statistics = RunningStatistics()
+    assert statistics.count == 0
+    assert np.isnan(statistics.variance())
+
+@pytest.mark.parametrize("useMask", [False, True])
+def test_calculateTemporalContrast(useMask):
+    stack = createStack(25, seed=1)
+    mask = None
+    validPixels = np.ones(stack.shape[1:], dtype=bool)
+    if useMask:
+        mask = np.full(stack.shape[1:], 255, dtype=np.uint8)
+        mask[::3, 2:9] = 0
+        validPixels = mask > 0
+    expected = np.mean(np.std(stack, axis=0)[validPixels] / np.mean(stack, axis=0)[validPixels] * 100)
+    assert calculateTemporalContrast(accumulate(stack), mask) == pytest.approx(expected, rel=1e-10)
+
+# Pixels without light (mean 0) have no contrast and are left out
+def test_calculateTemporalContrastSkipsDarkPixels():
+    stack = createStack(6, seed=2)
+    stack[:, :4, :] = 0
+    expected = np.mean(np.std(stack[:, 4:], axis=0) / np.mean(stack[:, 4:], axis=0) * 100)
+    assert calculateTemporalContrast(accumulate(stack)) == pytest.approx(expected, rel=1e-10)
+
+def test_calculateTemporalContrastConstantStack():
+    assert calculateTemporalContrast(accumulate([np.full((5, 5), 80.0)] * 4)) == 0
+
+def test_calculateTemporalContrastNeedsTwoFrames():
+    assert np.isnan(calculateTemporalContrast(accumulate(createStack(1))))
+    stack = createStack(3)
+    assert np.isnan(calculateTemporalContrast(accumulate(stack), np.zeros(stack.shape[1:], dtype=np.uint8)))
+
+def test_getMeanImage():
+    statistics = accumulate([np.array([[0, 10, 255]], dtype=np.uint8), np.array([[1, 13, 255]], dtype=np.uint8)])
+    meanImage = getMeanImage(statistics, np.uint8)
+    assert meanImage.dtype == np.uint8
+    assert np.array_equal(meanImage, [[0, 12, 255]])
+    assert np.array_equal(getMeanImage(statistics, np.float32), np.array([[0.5, 11.5, 255]], dtype=np.float32))
+
+@pytest.mark.parametrize("precision, bitDepth", [("uint8", None), ("uint16", 12), ("float32", None)])
+@pytest.mark.parametrize("channels", [None, 3])
+def test_iterateImageStackChannelNpy(tmp_path, precision, bitDepth, channels):
+    shape = (4, 9, 11) if channels is None else (4, 9, 11, channels)
+    stack = np.random.default_rng(4).integers(0, 65535, shape, dtype=np.uint16, endpoint=True)
+    filePath = str(tmp_path / "stack.npy")
+    np.save(filePath, stack)
+
+    expected = imageLoader.loadImageStackChannel(filePath, "npy", "r", precision, bitDepth)
+    frames = list(imageLoader.iterateImageStackChannel(filePath, "npy", "r", precision, bitDepth))
+    assert len(frames) == len(expected)
+    for frame, expectedFrame in zip(frames, expected):
+        assert frame.dtype == expectedFrame.dtype
+        assert np.array_equal(frame, expectedFrame)
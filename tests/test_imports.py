@@ -0,0 +1,13 @@
+import pytest
+from benchmark import measureImports, LIGHTWEIGHT_MODULES, IMPORT_TIME_BUDGET
+
+'''
+Import-time budget: every lightweight module has to import within IMPORT_TIME_BUDGET in a fresh interpreter
+without loading rawpy, OpenCV, scipy or matplotlib (see benchmark.measureImports()).
+'''
+
+@pytest.mark.parametrize("module", LIGHTWEIGHT_MODULES)
+def test_importWithinBudget(module):
+    imports = measureImports([module])[0]
+    assert imports["heavyModules"] == [], module + " loads " + ", ".join(imports["heavyModules"]) + " at import"
+    assert imports["withinBudget"], module + " takes {:.0f} ms to import (budget {:.0f} ms)".format(imports["seconds"]*1000, IMPORT_TIME_BUDGET*1000)
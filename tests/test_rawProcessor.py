@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from rawProcessor import normalizeRawImage, debayerSingleColor, processBayerImageTiled, getPrecision, RED, GREEN_1, BLUE, GREEN_2
+from tests.referenceImplementations import debayerSingleColorLoop, normalizeRawImageLoop
+
+'''
+Regression tests of the vectorized normalization and debayering against the previous pure-Python loops (see referenceImplementations.py).
+All uint8 outputs have to be bit-identical.
+The tiled multi-threaded processing has to match the single pass normalization and debayering in every precision.
+'''
+
+# Bayer patterns as rawpy raw_pattern
+BAYER_PATTERNS = {
+    "RGGB": [[RED, GREEN_1], [GREEN_2, BLUE]],
+    "GRBG": [[GREEN_1, RED], [BLUE, GREEN_2]],
+    "GBRG": [[GREEN_1, BLUE], [RED, GREEN_2]],
+    "BGGR": [[BLUE, GREEN_1], [GREEN_2, RED]]
+}
+
+# Raw shapes (height, width) with odd and even sides, down to a single pixel after the pattern conversion
+RAW_SHAPES = [(3, 3), (4, 4), (4, 7), (8, 8), (9, 8), (8, 9), (11, 13), (40, 62), (41, 63)]
+CHANNELS = ["r", "g", "b", "G", "rb"]
+# (blacklevel, whitelevel) per channel as rawpy (RED, GREEN_1, BLUE, GREEN_2)
+BLACK_LEVELS = {"shared": ([143, 143, 143, 143], [4095, 4095, 4095, 4095]),
+                "per channel": ([143, 150, 160, 150], [4095, 4000, 3900, 4000]),
+                "shared black, per channel white": ([143, 143, 143, 143], [4095, 4000, 3900, 4000])}
+
+def createRawImage(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 4096, shape, dtype=np.uint16)
+
+@pytest.mark.parametrize("pattern", list(BAYER_PATTERNS))
+@pytest.mark.parametrize("shape", RAW_SHAPES)
+@pytest.mark.parametrize("channel", CHANNELS)
+def test_debayerSingleColorMatchesLoop(pattern, shape, channel):
+    normalized = normalizeRawImage(createRawImage(shape), BAYER_PATTERNS[pattern], *BLACK_LEVELS["shared"])
+    expected = debayerSingleColorLoop(normalized, channel)
+    debayered = debayerSingleColor(normalized, channel)
+    assert debayered.dtype == expected.dtype
+    assert np.array_equal(debayered, expected)
+
+# The original per-channel loop underflows below the black level, so the raw values start above the highest black level there
+@pytest.mark.parametrize("pattern", list(BAYER_PATTERNS))
+@pytest.mark.parametrize("shape", [(4, 4), (9, 8), (11, 13)])
+@pytest.mark.parametrize("levels", list(BLACK_LEVELS))
+def test_normalizeRawImageMatchesLoop(pattern, shape, levels):
+    blacklevel, whitelevel = BLACK_LEVELS[levels]
+    rawImage = createRawImage(shape) if levels == "shared" else createRawImage(shape) // 2 + max(blacklevel)
+    expected = normalizeRawImageLoop(rawImage.copy(), BAYER_PATTERNS[pattern], blacklevel, whitelevel)
+    normalized = normalizeRawImage(rawImage, BAYER_PATTERNS[pattern], blacklevel, whitelevel)
+    assert normalized.dtype == np.uint8
+    assert np.array_equal(normalized, expected)
+
+@pytest.mark.parametrize("levels", list(BLACK_LEVELS))
+def test_normalizeRawImageKeepsRawImage(levels):
+    rawImage = createRawImage((40, 62))
+    rawImageBefore = rawImage.copy()
+    normalizeRawImage(rawImage, BAYER_PATTERNS["RGGB"], *BLACK_LEVELS[levels])
+    assert np.array_equal(rawImage, rawImageBefore)
+
+def test_normalizeRawImageOutBuffer():
+    rawImage = createRawImage((41, 63))
+    expected = normalizeRawImage(rawImage, BAYER_PATTERNS["GRBG"], *BLACK_LEVELS["per channel"])
+    out = np.full(expected.shape, 7, dtype=np.uint8)
+    normalized = normalizeRawImage(rawImage, BAYER_PATTERNS["GRBG"], *BLACK_LEVELS["per channel"], out=out)
+    assert normalized is out
+    assert np.array_equal(out, expected)
+    with pytest.raises(Exception):
+        normalizeRawImage(rawImage, BAYER_PATTERNS["GRBG"], *BLACK_LEVELS["per channel"], out=np.empty((2, 2), dtype=np.uint8))
+
+@pytest.mark.parametrize("levels", list(BLACK_LEVELS))
+def test_normalizeRawImageFloat32(levels):
+    blacklevel, whitelevel = BLACK_LEVELS[levels]
+    rawImage = createRawImage((40, 62))
+    normalized = normalizeRawImage(rawImage, BAYER_PATTERNS["BGGR"], blacklevel, whitelevel, np.float32)
+    integerNormalized = normalizeRawImage(rawImage, BAYER_PATTERNS["BGGR"], blacklevel, whitelevel)
+    assert normalized.dtype == np.float32
+    # Same values as uint8 with the fractional part, clamped at the black level
+    assert np.array_equal(np.floor(normalized + 1e-4).astype(np.uint8), integerNormalized)
+    assert normalized.min() >= 0 and np.any(normalized % 1 != 0)
+
+@pytest.mark.parametrize("pattern", list(BAYER_PATTERNS))
+@pytest.mark.parametrize("shape", [(8, 8), (41, 63), (102, 77)])
+@pytest.mark.parametrize("levels", list(BLACK_LEVELS))
+@pytest.mark.parametrize("precision, bitDepth", [("uint8", None), ("uint16", 12), ("float32", None)])
+@pytest.mark.parametrize("tileRows, threads", [(2, 2), (3, 4), (10, 3), (256, 2)])
+def test_processBayerImageTiledMatchesSinglePass(pattern, shape, levels, precision, bitDepth, tileRows, threads):
+    rawImage = createRawImage(shape, seed=1)
+    blacklevel, whitelevel = BLACK_LEVELS[levels]
+    outputType, whiteValue = getPrecision(precision, bitDepth)
+    normalized = normalizeRawImage(rawImage, BAYER_PATTERNS[pattern], blacklevel, whitelevel, outputType, whiteValue=whiteValue)
+    debayered = processBayerImageTiled(rawImage, BAYER_PATTERNS[pattern], blacklevel, whitelevel, ["r", "g", "b"], outputType, whiteValue, tileRows, threads)
+    for channel in ["r", "g", "b"]:
+        expected = debayerSingleColor(normalized, channel)
+        assert debayered[channel].dtype == expected.dtype
+        assert np.array_equal(debayered[channel], expected)
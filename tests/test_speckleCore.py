@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from speckleCore import findBrightestArea
+from tests.referenceImplementations import findBrightestAreaLoop
+
+'''
+Regression tests of the vectorized brightest-area search against the previous exhaustive loop (see referenceImplementations.py).
+findBrightestArea() needs OpenCV for the integral image.
+'''
+
+pytest.importorskip("cv2")
+
+# (image shape, area size (width, height))
+AREA_CASES = [((40, 50), (7, 7)), ((41, 63), (12, 5)), ((30, 30), (30, 30)), ((25, 60), (1, 1)), ((64, 48), (20, 33))]
+
+def createImage(shape, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    if dtype == np.float32:
+        return rng.random(shape, dtype=np.float32) * 255
+    return rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype, endpoint=True)
+
+@pytest.mark.parametrize("shape, areaSize", AREA_CASES)
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.float32])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_findBrightestAreaMatchesLoop(shape, areaSize, dtype, seed):
+    image = createImage(shape, dtype, seed)
+    assert findBrightestArea(image, areaSize) == findBrightestAreaLoop(image, areaSize)
+
+# Equal sums: the first position (row by row) wins like in the loop
+def test_findBrightestAreaFirstMaximum():
+    image = np.full((20, 30), 100, dtype=np.uint8)
+    assert findBrightestArea(image, (5, 5)) == findBrightestAreaLoop(image, (5, 5)) == [0, 0, 5, 5]
+
+@pytest.mark.parametrize("coarseStep", [2, 5, 8])
+def test_findBrightestAreaCoarseToFine(coarseStep):
+    image = createImage((120, 150), np.uint8) // 4
+    image[37:37+20, 91:91+20] = 255
+    assert findBrightestArea(image, (20, 20), coarseStep=coarseStep) == findBrightestAreaLoop(image, (20, 20)) == [91, 37, 20, 20]